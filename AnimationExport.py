@@ -0,0 +1,194 @@
+# import the different libraries
+
+import os
+import shutil
+import subprocess
+import tempfile
+import concurrent.futures as cf
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# create a function rendering a chunk of frames, run by the worker processes
+
+def renderChunk(drawFrame,
+                frames,
+                iStart: int,
+                pngDir: str,
+                figSize,
+                dpi: int):
+    '''Renders frames to PNG files with the non-interactive Agg canvas
+
+
+    Parameters
+    ----------
+    drawFrame : function
+        Function drawing a frame on an empty figure, called as drawFrame(fig, frame). It has to be
+        defined at the top level of a module to be sent to the worker processes.
+    frames : list
+        Data of the frames to render.
+    iStart : int
+        Index of the first frame, used for the file names.
+    pngDir : str
+        Directory of the PNG files.
+    figSize : tuple
+        Size of the figure in inches.
+    dpi : int
+        Resolution of the PNG files.
+
+    Returns
+    -------
+    Number of frames rendered.
+
+    '''
+
+    for i, frame in enumerate(frames):
+        fig = Figure(figsize = figSize)
+        FigureCanvasAgg(fig)
+        drawFrame(fig, frame)
+        fig.savefig(os.path.join(pngDir, "frame_%06d.png" % (iStart + i)), dpi = dpi)
+
+    return(len(frames))
+
+# create a function rendering all the frames in parallel
+
+def ExportFrames(drawFrame,
+                 frames,
+                 outputPath: str,
+                 nProcesses: int = None,
+                 chunkSize: int = 50,
+                 fps: int = 25,
+                 figSize = (6.4, 4.8),
+                 dpi: int = 100):
+    '''Renders frames over a process pool to a PNG sequence, a GIF or a MP4 file
+
+    The frames are rendered by renderFrames. For a GIF or a MP4 file they go to a temporary
+    directory, removed once the file is encoded or if an error occurs.
+
+    Parameters
+    ----------
+    drawFrame : function
+        Function drawing a frame on an empty figure, called as drawFrame(fig, frame). It has to be
+        defined at the top level of a module to be sent to the worker processes.
+    frames : iterable
+        Data of the frames to render, in order.
+    outputPath : str
+        Either a ".gif" or ".mp4" file, or a directory for the PNG sequence frame_000000.png, ...
+        The MP4 encoding needs ffmpeg.
+    nProcesses : int
+        Number of worker processes. Default to the number of CPUs.
+    chunkSize : int
+        Number of frames rendered by a worker at once.
+    fps : int
+        Frames per second of the GIF or MP4 file.
+    figSize : tuple
+        Size of the figure in inches.
+    dpi : int
+        Resolution of the frames.
+
+    Returns
+    -------
+    Number of frames rendered.
+
+    '''
+
+    # check the output type
+
+    ext = os.path.splitext(outputPath)[1].lower()
+
+    if ext == ".mp4":
+        ffmpeg = shutil.which(matplotlib.rcParams["animation.ffmpeg_path"])
+        if ffmpeg is None:
+            print("ffmpeg is not available, use a \".gif\" file or a PNG directory instead.")
+            return(None)
+    elif ext == ".gif":
+        
+        # Pillow is only needed to encode the GIF files
+        
+        try:
+            from PIL import Image
+        except ImportError:
+            print("Pillow is not available, use a \".mp4\" file or a PNG directory instead.")
+            return(None)
+    elif ext != "":
+        print("The output should be a \".gif\" or \".mp4\" file or a directory.")
+        return(None)
+
+    if ext == "":
+        os.makedirs(outputPath, exist_ok = True)
+        return(renderFrames(drawFrame, frames, outputPath, nProcesses, chunkSize, figSize, dpi))
+
+    # render to a temporary directory, removed even if the rendering or the encoding fails
+
+    with tempfile.TemporaryDirectory() as pngDir:
+        nFrames = renderFrames(drawFrame, frames, pngDir, nProcesses, chunkSize, figSize, dpi)
+
+        # encode the PNG sequence
+
+        pngPattern = os.path.join(pngDir, "frame_%06d.png")
+
+        if ext == ".gif" and nFrames > 0:
+            images = (Image.open(pngPattern % i) for i in range(1, nFrames))
+            first = Image.open(pngPattern % 0)
+            first.save(outputPath, save_all = True, append_images = images, duration = 1000/fps, loop = 0)
+        elif ext == ".mp4" and nFrames > 0:
+            subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-framerate", str(fps), "-i", pngPattern,
+                            "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", outputPath],
+                           check = True)
+
+    return(nFrames)
+
+# create a function rendering the frames over a process pool to a PNG directory
+
+def renderFrames(drawFrame,
+                 frames,
+                 pngDir: str,
+                 nProcesses: int,
+                 chunkSize: int,
+                 figSize,
+                 dpi: int):
+    '''Renders frames over a process pool to the PNG files frame_000000.png, ... of pngDir
+
+    The frames are read from an iterable, so they can be produced one by one while the previous
+    chunks are rendered. At most two chunks per process are waiting at any time.
+
+    Returns
+    -------
+    Number of frames rendered.
+
+    '''
+
+    # render the chunks as the frames come
+
+    if nProcesses is None:
+        nProcesses = os.cpu_count()
+
+    nFrames = 0
+    with cf.ProcessPoolExecutor(max_workers = nProcesses) as pool:
+        pending = set()
+        chunk = []
+
+        for frame in frames:
+            chunk.append(frame)
+
+            if len(chunk) == chunkSize:
+
+                # wait for a chunk to be done before sending too many of them
+
+                if len(pending) >= 2*nProcesses:
+                    done, pending = cf.wait(pending, return_when = cf.FIRST_COMPLETED)
+                    for f in done:
+                        f.result()
+
+                pending.add(pool.submit(renderChunk, drawFrame, chunk, nFrames, pngDir, figSize, dpi))
+                nFrames = nFrames + len(chunk)
+                chunk = []
+
+        if len(chunk) > 0:
+            pending.add(pool.submit(renderChunk, drawFrame, chunk, nFrames, pngDir, figSize, dpi))
+            nFrames = nFrames + len(chunk)
+
+        for f in pending:
+            f.result()
+
+    return(nFrames)
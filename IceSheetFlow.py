@@ -3,13 +3,251 @@
 import numpy as np
 import matplotlib.pyplot as plt 
 import matplotlib.animation as ani
+import functools
+import warnings
+import AnimationExport
+
+def IceSheetStepLoop(elevation,
+                     flow,
+                     dX:float,
+                     timeStep:int,
+                     flowParam:float,
+                     snowFall:float):
+    '''Steps the ice sheet forward of one time step, one grid point at a time
+    
+    Slow reference implementation of IceSheetStep. Although the elevation update reads flow[ix-1] 
+    as just computed in the same sweep, flow[ix] is computed before elevation[ix] is updated, so all 
+    the flows come from the elevations of the previous step and the sweep is a pure explicit update.
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the nX grid points and of the two ghost points, updated in place.
+    flow : numpy array
+        Flows between the grid points, updated in place.
+    dX : float
+        Grid step in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+    snowFall : float
+        The fall rate of the snow in meter per year.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    nX = len(elevation) - 2
+    
+    # loop over the elevations 
+    
+    for ix in range(nX+2):
+        
+        # set the values to 0 for the second ghost val
+        
+        if ix == nX+1:
+            elevation[ix] = 0
+            flow[ix] = 0
+        else:
+            
+            # iterate over the flow
+            
+            flow[ix] = (elevation[ix] - elevation[ix+1])/dX * flowParam*(elevation[ix]+elevation[ix+1])/2/dX
+        
+            # iterate the elevation value setting the first and last value to 0
+        
+            if ix == 0:
+                elevation[ix] = 0
+            else:
+                elevation[ix] = elevation[ix] + (snowFall + flow[ix-1] - flow[ix])*timeStep
+
+def IceSheetStep(elevation,
+                 flow,
+                 dX:float,
+                 timeStep:int,
+                 flowParam:float,
+                 snowFall:float):
+    '''Steps the ice sheet forward of one time step with whole-array operations
+    
+    The diffusive flux is computed over the whole array from the elevations of the previous step 
+    and then the elevation is updated, which gives the same result as IceSheetStepLoop. The grid 
+    points are on the last axis so several ice sheets can be stepped together.
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the nX grid points and of the two ghost points, updated in place.
+    flow : numpy array
+        Flows between the grid points, updated in place.
+    dX : float
+        Grid step in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+    snowFall : float
+        The fall rate of the snow in meter per year.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    nX = elevation.shape[-1] - 2
+    
+    # diffusive flux between each grid point and the next one, none out of the last ghost point 
+    
+    flow[...,0:nX+1] = (elevation[...,0:nX+1] - elevation[...,1:nX+2])/dX * flowParam*(elevation[...,0:nX+1]+elevation[...,1:nX+2])/2/dX
+    flow[...,nX+1] = 0
+    
+    # elevation update keeping the ghost points at 0
+    
+    elevation[...,1:nX+1] = elevation[...,1:nX+1] + (snowFall + flow[...,0:nX] - flow[...,1:nX+1])*timeStep
+    elevation[...,0] = 0
+    elevation[...,nX+1] = 0
+
+def IceSheetStepImplicit(elevation,
+                         flow,
+                         dX:float,
+                         timeStep:int,
+                         flowParam:float,
+                         snowFall:float):
+    '''Steps the ice sheet forward of one time step with a semi-implicit scheme
+    
+    The flow between two grid points is K*(elevation[ix] - elevation[ix+1]) with the diffusivity 
+    K = flowParam*(elevation[ix] + elevation[ix+1])/2/dX/dX. K is taken from the previous step and 
+    the elevations from the new one, which gives a tridiagonal system solved with the Thomas 
+    algorithm. It stays stable for any time step, so long time steps can be used on fine grids. 
+    The grid points are on the last axis so several ice sheets can be stepped together.
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the nX grid points and of the two ghost points, updated in place.
+    flow : numpy array
+        Flows between the grid points, updated in place.
+    dX : float
+        Grid step in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+    snowFall : float
+        The fall rate of the snow in meter per year.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    nX = elevation.shape[-1] - 2
+    
+    # diffusivity between each grid point and the next one 
+    
+    K = flowParam*(elevation[...,0:nX+1] + elevation[...,1:nX+2])/2/dX/dX
+    
+    # tridiagonal system for the nX grid points, the ghost points staying at 0
+    
+    sub = -timeStep*K[...,0:nX]
+    sup = -timeStep*K[...,1:nX+1]
+    diag = 1 - sub - sup
+    rhs = elevation[...,1:nX+1] + snowFall*timeStep
+    
+    # forward sweep of the Thomas algorithm 
+    
+    cp = np.empty(diag.shape)
+    dp = np.empty(diag.shape)
+    cp[...,0] = sup[...,0]/diag[...,0]
+    dp[...,0] = rhs[...,0]/diag[...,0]
+    for ix in range(1, nX):
+        m = diag[...,ix] - sub[...,ix]*cp[...,ix-1]
+        cp[...,ix] = sup[...,ix]/m
+        dp[...,ix] = (rhs[...,ix] - sub[...,ix]*dp[...,ix-1])/m
+    
+    # back substitution 
+    
+    elevation[...,nX] = dp[...,nX-1]
+    for ix in range(nX-2, -1, -1):
+        elevation[...,ix+1] = dp[...,ix] - cp[...,ix]*elevation[...,ix+2]
+    elevation[...,0] = 0
+    elevation[...,nX+1] = 0
+    
+    # flows used by the step 
+    
+    flow[...,0:nX+1] = K*(elevation[...,0:nX+1] - elevation[...,1:nX+2])
+    flow[...,nX+1] = 0
+
+def IceSheetStability(elevation,
+                      dX:float,
+                      timeStep:int,
+                      flowParam:float):
+    '''Returns the stability number of the explicit time step
+    
+    The explicit update of a grid point stays stable and positive while timeStep times the sum of 
+    the diffusivities on both sides is below 1, i.e. timeStep below about dX^2/(flowParam*elevation).
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the nX grid points and of the two ghost points.
+    dX : float
+        Grid step in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+
+    Returns
+    -------
+    Largest stability number over the grid, the explicit step being stable below 1.
+
+    '''
+    
+    return(np.max(timeStep*flowParam*(elevation[...,:-2] + 2*elevation[...,1:-1] + elevation[...,2:])/2/dX/dX))
+
+def IceSheetDiverged(elevation,
+                     peak,
+                     axis = -1):
+    '''Returns which ice sheets diverged
+    
+    A stable run growing from a flat ground stays below its steady state, so an ice sheet diverged 
+    once its elevations are not finite or go beyond twice its steady peak. IceSheetStability above 
+    1 only means that the explicit step may diverge.
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations with the ghost points.
+    peak : float or array
+        Peak elevation of the steady state, broadcast against the elevations.
+    axis : int or tuple
+        Axes of the grid points, the other ones being the ice sheets.
+
+    Returns
+    -------
+    Boolean, or boolean array over the ice sheets.
+
+    '''
+    
+    return(np.any(~np.isfinite(elevation) | (np.abs(elevation) > 2*peak), axis=axis))
 
 def IceSheetDF(nX:int,
                domainWidth:int,
                timeStep:int,
                nYears:int,
                flowParam:float,
-               snowFall:float):
+               snowFall:float,
+               method:str = "vectorized",
+               outputEvery:int = 1,
+               outputTimes = None,
+               steadyTol:float = None,
+               steadyCriterion:str = "elevation",
+               finalOnly:bool = False):
     '''Returns DF for the Ice Sheet flow model
     
 
@@ -17,71 +255,492 @@ def IceSheetDF(nX:int,
     ----------
     nX : int
         Number of grid points.
-    domainWidth : int
+    domainWidth : int or array
         Width of the Ice Sheet in meters.
     timeStep : int
         Years for the time step.
     nYears : int
         Total number of years to span over.
-    flowParam : float
+    flowParam : float or array
         The flow rate of the ice in meter per year.
-    snowFall : float
+    snowFall : float or array
         The fall rate of the snow in meter per year.
+    method : str
+        "vectorized" to step with IceSheetStep, "loop" to step with the slow reference 
+        IceSheetStepLoop. Both give the same explicit update, which may diverge when timeStep 
+        is above about dX^2/(flowParam*elevation). A member diverging, as told by 
+        IceSheetDiverged, raises a RuntimeWarning and its elevations are NaN from that step on, 
+        the run stopping once all the members diverged. "implicit" steps with 
+        IceSheetStepImplicit, which is stable for any time step.
+    outputEvery : int
+        Keep the elevations of one time step out of outputEvery, starting with year 0.
+    outputTimes : array
+        If given, years for which the elevations are kept instead of using outputEvery. Each one 
+        is taken at the first time step reaching it.
+    steadyTol : float
+        If given, the run stops at the first time step where the ice sheet is steady within 
+        steadyTol, and the last row of the data frame gives the year it converged. For an 
+        ensemble, the run stops once all the members are steady.
+    steadyCriterion : str
+        "elevation" for the largest elevation change in meter per year, "massBalance" for the 
+        relative difference between the snow falling on the ice sheet and the flow out of it.
+    finalOnly : bool
+        Keep only the final elevations.
 
     Returns
     -------
-    Data frame containing the elevation values of the ice sheet over years.
+    Data frame containing the elevation values of the ice sheet over years. The final state is 
+    always included. If any of domainWidth, flowParam or snowFall is an array, they are broadcast 
+    together and all the members are stepped together as a (nMembers, nX+2) array, the data frame 
+    is then of shape (nMembers, nKept, nX+3) with the members in the flattened broadcast order.
 
     '''
 
-    # define the grid steps  
+    # broadcast the parameters over the ensemble members, on a column to broadcast over the grid points
+    
+    domainWidth, flowParam, snowFall = np.broadcast_arrays(domainWidth, flowParam, snowFall)
+    
+    if domainWidth.ndim == 0:
+        memberShape = ()
+        domainWidth, flowParam, snowFall = [float(p) for p in (domainWidth, flowParam, snowFall)]
+    else:
+        memberShape = (domainWidth.size,)
+        domainWidth, flowParam, snowFall = [p.reshape(-1,1).astype(float) for p in (domainWidth, flowParam, snowFall)]
+
+    # define the grid steps and the steady peak bounding a stable run 
     
     dX = domainWidth/nX
+    peak = np.sqrt(snowFall/flowParam)*(nX+1)*dX/2
+
+    # get the number of time steps and the ones to keep, the final one being always kept 
+    
+    nSteps = max(int(np.ceil(nYears/timeStep)), 0)
+    
+    if finalOnly:
+        keepSteps = np.array([], dtype=int)
+    elif outputTimes is not None:
+        keepSteps = np.clip(np.ceil(np.asarray(outputTimes)/timeStep).astype(int), 0, nSteps)
+    else:
+        keepSteps = np.arange(0, nSteps+1, outputEvery)
+    keepSteps = np.union1d(keepSteps, [nSteps])
 
-    # initialize the data
+    # initialize the data, the output having one row per kept step with the year and the elevations
     
-    years = [0,]
-    flow = [0 for i in range(nX+2)]
-    elevation = [0 for i in range(nX+2)]
-    elevationArr = elevation
+    flow = np.zeros(memberShape + (nX+2,))
+    elevation = np.zeros(memberShape + (nX+2,))
+    previous = np.zeros(memberShape + (nX+2,))
+    out = np.empty(memberShape + (len(keepSteps), nX+3))
+    diverged = np.zeros(memberShape, dtype=bool)
+    iKeep = 0
     
     # loop over the years 
     
-    while years[-1] < nYears:
-        years = np.append(years, years[-1] + timeStep)
+    for iStep in range(nSteps+1):
         
-        # loop over the elevations 
+        converged = False
         
-        for ix in range(nX+2):
+        # update the flow and the elevations 
+        
+        if iStep > 0:
             
-            # set the values to 0 for the second ghost val
+            if steadyTol is not None:
+                previous[:] = elevation
             
-            if ix == nX+1:
-                elevation[ix] = 0
-                flow[ix] = 0
+            if method == "implicit":
+                IceSheetStepImplicit(elevation, flow, dX, timeStep, flowParam, snowFall)
+            elif method == "loop" and memberShape == ():
+                IceSheetStepLoop(elevation, flow, dX, timeStep, flowParam, snowFall)
+            elif method == "loop":
+                for iMember in range(memberShape[0]):
+                    IceSheetStepLoop(elevation[iMember], flow[iMember], dX[iMember,0], timeStep, 
+                                     flowParam[iMember,0], snowFall[iMember,0])
             else:
-                
-                # iterate over the flow
-                
-                flow[ix] = (elevation[ix] - elevation[ix+1])/dX * flowParam*(elevation[ix]+elevation[ix+1])/2/dX
+                IceSheetStep(elevation, flow, dX, timeStep, flowParam, snowFall)
+            
+            # stop the members whose explicit update diverged 
             
-                # iterate the elevation value setting the first and last value to 0
+            if method != "implicit":
+                newDiverged = IceSheetDiverged(elevation, peak) & ~diverged
+                if np.any(newDiverged):
+                    members = "" if memberShape == () else " for the members " + str(np.flatnonzero(newDiverged).tolist())
+                    warnings.warn("The run diverged at year " + str(iStep*timeStep) + members + 
+                                  ", use a smaller timeStep or method = \"implicit\".", RuntimeWarning)
+                    diverged = diverged | newDiverged
+                    elevation[diverged] = np.nan
+                    flow[diverged] = np.nan
             
-                if ix == 0:
-                    elevation[ix] = 0
+            # check if the ice sheet is steady 
+            
+            if steadyTol is not None and not np.all(diverged):
+                if steadyCriterion == "massBalance":
+                    residual = np.abs(nX*snowFall + flow[...,0:1] - flow[...,nX:nX+1])/(nX*snowFall)
                 else:
-                    elevation[ix] = elevation[ix] + (snowFall + flow[ix-1] - flow[ix])*timeStep
+                    residual = np.abs(elevation - previous)/timeStep
+                converged = np.max(residual[~diverged]) < steadyTol
                 
-        # append elevation to elevation array
+        # store the year and the elevations, the steady state or the divergence of all the members ending the run 
         
-        elevationArr = np.vstack((elevationArr, elevation))
-   
-   # bundle years and elevationArr     
+        stop = converged or np.all(diverged)
+        
+        if iStep == keepSteps[iKeep] or stop:
+            out[...,iKeep,0] = iStep*timeStep
+            out[...,iKeep,1:] = elevation
+            iKeep = iKeep + 1
+        
+        if stop:
+            break
    
-    out = np.hstack((years[:,np.newaxis],elevationArr))
+    return(out[...,:iKeep,:])
+
+def IceSheetSteady(nX:int,
+                   domainWidth:int,
+                   flowParam,
+                   snowFall):
+    '''Returns the analytic steady state elevations of the Ice Sheet flow model
     
-   
-    return(out)
+    With a flow proportional to the elevation times the slope, the steady state satisfies 
+    flowParam/2 * d2(elevation^2)/dx2 = -snowFall, which gives the Vialov-like elliptic profile 
+    elevation = sqrt(snowFall/flowParam * x*(width - x)). On the grid of IceSheetDF the ghost 
+    points are at x = 0 and x = (nX+1)*dX, and the discrete steady state is exactly this profile.
+
+    Parameters
+    ----------
+    nX : int
+        Number of grid points.
+    domainWidth : int
+        Width of the Ice Sheet in meters.
+    flowParam : float or array
+        The flow rate of the ice in meter per year.
+    snowFall : float or array
+        The fall rate of the snow in meter per year.
+
+    Returns
+    -------
+    Array of the nX+2 elevations with the ghost points, as in a row of the IceSheetDF data frame 
+    without the year. For arrays of flowParam or snowFall the grid points are on the last axis.
+
+    '''
+    
+    dX = domainWidth/nX
+    x = dX*np.arange(nX+2)
+    
+    ratio = np.asarray(snowFall/np.asarray(flowParam, dtype=float))[...,np.newaxis]
+    
+    return(np.sqrt(ratio*x*((nX+1)*dX - x)))
+
+def IceSheet2DStep(elevation,
+                   flowX,
+                   flowY,
+                   dX:float,
+                   dY:float,
+                   timeStep:int,
+                   flowParam:float,
+                   snowFall:float):
+    '''Steps the two dimensional ice sheet forward of one time step with whole-array operations
+    
+    Same explicit update as IceSheetStep with the flows on a staggered grid: flowX between each 
+    point and the next one along x, flowY between each point and the next one along y.
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the nY x nX grid points with a border of ghost points, of shape (nY+2, nX+2), 
+        updated in place.
+    flowX : numpy array
+        Flows along x, of shape (nY+2, nX+1), updated in place.
+    flowY : numpy array
+        Flows along y, of shape (nY+1, nX+2), updated in place.
+    dX : float
+        Grid step along x in meters.
+    dY : float
+        Grid step along y in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+    snowFall : float
+        The fall rate of the snow in meter per year.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    nY = elevation.shape[-2] - 2
+    nX = elevation.shape[-1] - 2
+    
+    # diffusive flux on the staggered grid 
+    
+    flowX[...] = (elevation[...,:,0:nX+1] - elevation[...,:,1:nX+2])/dX * flowParam*(elevation[...,:,0:nX+1]+elevation[...,:,1:nX+2])/2/dX
+    flowY[...] = (elevation[...,0:nY+1,:] - elevation[...,1:nY+2,:])/dY * flowParam*(elevation[...,0:nY+1,:]+elevation[...,1:nY+2,:])/2/dY
+    
+    # elevation update of the inner points, the ghost border staying at 0
+    
+    elevation[...,1:nY+1,1:nX+1] = elevation[...,1:nY+1,1:nX+1] + (snowFall 
+                                                                  + flowX[...,1:nY+1,0:nX] - flowX[...,1:nY+1,1:nX+1] 
+                                                                  + flowY[...,0:nY,1:nX+1] - flowY[...,1:nY+1,1:nX+1])*timeStep
+
+def IceSheet2DStepImplicit(elevation,
+                           flowX,
+                           flowY,
+                           dX:float,
+                           dY:float,
+                           timeStep:int,
+                           flowParam:float,
+                           snowFall:float):
+    '''Steps the two dimensional ice sheet forward of one time step with a semi-implicit scheme
+    
+    The diffusivities are taken from the previous step and the elevations from the new one, as in 
+    IceSheetStepImplicit, which gives one symmetric positive definite five diagonal system for all 
+    the grid points. It is assembled with scipy.sparse and solved by a sparse LU factorization, 
+    whose cost grows about as (nX*nY)^1.5. The fixed point of the step is the steady state of the 
+    explicit model whatever the time step, and the elevations stay positive. The step is first 
+    order in time: the transient follows the explicit one for time steps near its stability limit 
+    and lags it for much longer ones. The grids are on the last two axes so several ice sheets can 
+    be stepped together, each one being solved in turn.
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the nY x nX grid points with a border of ghost points, of shape (nY+2, nX+2), 
+        updated in place.
+    flowX : numpy array
+        Flows along x, of shape (nY+2, nX+1), updated in place.
+    flowY : numpy array
+        Flows along y, of shape (nY+1, nX+2), updated in place.
+    dX : float
+        Grid step along x in meters.
+    dY : float
+        Grid step along y in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+    snowFall : float
+        The fall rate of the snow in meter per year.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    # scipy is only needed by this method 
+    
+    import scipy.sparse
+    import scipy.sparse.linalg
+    
+    nY = elevation.shape[-2] - 2
+    nX = elevation.shape[-1] - 2
+    
+    # diffusivities between the inner points and their neighbours, from the previous step
+    
+    KX = flowParam*(elevation[...,1:nY+1,0:nX+1] + elevation[...,1:nY+1,1:nX+2])/2/dX/dX
+    KY = flowParam*(elevation[...,0:nY+1,1:nX+1] + elevation[...,1:nY+2,1:nX+1])/2/dY/dY
+    
+    # diagonals of the system for the inner points numbered row by row, the ghost border being at 0 
+    
+    diag = 1 + (KX[...,:,0:nX] + KX[...,:,1:nX+1] + KY[...,0:nY,:] + KY[...,1:nY+1,:])*timeStep
+    offX = np.zeros(diag.shape)
+    offX[...,:,0:nX-1] = -KX[...,:,1:nX]*timeStep
+    offY = -KY[...,1:nY,:]*timeStep
+    rhs = np.broadcast_to(elevation[...,1:nY+1,1:nX+1] + snowFall*timeStep, diag.shape)
+    
+    diag, offX, offY, rhs = [a.reshape((-1,) + a.shape[-2:]) for a in (diag, offX, offY, rhs)]
+    inner = np.empty(diag.shape)
+    
+    for iSheet in range(diag.shape[0]):
+        offXFlat = offX[iSheet].ravel()[:-1]
+        offYFlat = offY[iSheet].ravel()
+        matrix = scipy.sparse.diags([diag[iSheet].ravel(), offXFlat, offXFlat, offYFlat, offYFlat], 
+                                    [0, 1, -1, nX, -nX], format="csc")
+        lu = scipy.sparse.linalg.splu(matrix, permc_spec="MMD_AT_PLUS_A")
+        inner[iSheet] = lu.solve(rhs[iSheet].ravel()).reshape(nY, nX)
+    
+    elevation[...,1:nY+1,1:nX+1] = np.maximum(inner.reshape(elevation[...,1:nY+1,1:nX+1].shape), 0)
+    
+    # flows of the new elevations with the diffusivities of the step 
+    
+    flowX[...] = 0
+    flowY[...] = 0
+    flowX[...,1:nY+1,:] = KX*(elevation[...,1:nY+1,0:nX+1] - elevation[...,1:nY+1,1:nX+2])
+    flowY[...,:,1:nX+1] = KY*(elevation[...,0:nY+1,1:nX+1] - elevation[...,1:nY+2,1:nX+1])
+
+def IceSheet2DStability(elevation,
+                        dX:float,
+                        dY:float,
+                        timeStep:int,
+                        flowParam:float):
+    '''Returns the stability number of the explicit two dimensional time step
+    
+
+    Parameters
+    ----------
+    elevation : numpy array
+        Elevations of the grid points with a border of ghost points, of shape (nY+2, nX+2).
+    dX : float
+        Grid step along x in meters.
+    dY : float
+        Grid step along y in meters.
+    timeStep : int
+        Years for the time step.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+
+    Returns
+    -------
+    Largest stability number over the grid, the explicit step being stable below 1.
+
+    '''
+    
+    inner = elevation[...,1:-1,1:-1]
+    
+    return(np.max(timeStep*flowParam/2*((elevation[...,1:-1,:-2] + 2*inner + elevation[...,1:-1,2:])/dX/dX 
+                                        + (elevation[...,:-2,1:-1] + 2*inner + elevation[...,2:,1:-1])/dY/dY)))
+
+def IceSheet2DDF(nX:int,
+                 nY:int,
+                 domainWidth:int,
+                 domainLength:int,
+                 timeStep:int,
+                 nYears:int,
+                 flowParam:float,
+                 snowFall:float,
+                 method:str = "explicit",
+                 outputEvery:int = 1,
+                 outputTimes = None,
+                 steadyTol:float = None):
+    '''Returns the years and elevations of the two dimensional Ice Sheet flow model
+    
+    Same model as IceSheetDF on a nY x nX grid, the ice sheet having a zero thickness on its margins.
+
+    Parameters
+    ----------
+    nX : int
+        Number of grid points along x.
+    nY : int
+        Number of grid points along y.
+    domainWidth : int
+        Width of the Ice Sheet along x in meters.
+    domainLength : int
+        Length of the Ice Sheet along y in meters.
+    timeStep : int
+        Years for the time step.
+    nYears : int
+        Total number of years to span over.
+    flowParam : float
+        The flow rate of the ice in meter per year.
+    snowFall : float
+        The fall rate of the snow in meter per year.
+    method : str
+        "explicit" to step with IceSheet2DStep, which stops with a RuntimeWarning at the step it 
+        diverged, as in IceSheetDF, the last kept elevations being NaN. "implicit" to step with 
+        IceSheet2DStepImplicit.
+    outputEvery : int
+        Keep the elevations of one time step out of outputEvery, starting with year 0.
+    outputTimes : array
+        If given, years for which the elevations are kept instead of using outputEvery.
+    steadyTol : float
+        If given, the run stops at the first time step where the largest elevation change is 
+        below steadyTol in meter per year.
+
+    Returns
+    -------
+    Array of the kept years and array of the kept elevations of shape (nKept, nY+2, nX+2), the 
+    ghost border included. The final state is always included.
+
+    '''
+
+    # define the grid steps and the steady peak across the narrowest side bounding a stable run 
+    
+    dX = domainWidth/nX
+    dY = domainLength/nY
+    peak = np.sqrt(snowFall/flowParam)*min((nX+1)*dX, (nY+1)*dY)/2
+
+    # get the number of time steps and the ones to keep, the final one being always kept 
+    
+    nSteps = max(int(np.ceil(nYears/timeStep)), 0)
+    
+    if outputTimes is not None:
+        keepSteps = np.clip(np.ceil(np.asarray(outputTimes)/timeStep).astype(int), 0, nSteps)
+    else:
+        keepSteps = np.arange(0, nSteps+1, outputEvery)
+    keepSteps = np.union1d(keepSteps, [nSteps])
+
+    # initialize the data 
+    
+    elevation = np.zeros((nY+2, nX+2))
+    previous = np.zeros((nY+2, nX+2))
+    flowX = np.zeros((nY+2, nX+1))
+    flowY = np.zeros((nY+1, nX+2))
+    years = np.empty(len(keepSteps))
+    elevationArr = np.empty((len(keepSteps), nY+2, nX+2))
+    iKeep = 0
+    
+    # loop over the years 
+    
+    for iStep in range(nSteps+1):
+        
+        converged = False
+        diverged = False
+        
+        if iStep > 0:
+            
+            if steadyTol is not None:
+                previous[:] = elevation
+            
+            if method == "implicit":
+                IceSheet2DStepImplicit(elevation, flowX, flowY, dX, dY, timeStep, flowParam, snowFall)
+            else:
+                IceSheet2DStep(elevation, flowX, flowY, dX, dY, timeStep, flowParam, snowFall)
+            
+            # stop the run if the explicit update diverged 
+            
+            if method != "implicit" and IceSheetDiverged(elevation, peak, axis=(-2,-1)):
+                warnings.warn("The run diverged at year " + str(iStep*timeStep) + 
+                              ", use a smaller timeStep or method = \"implicit\".", RuntimeWarning)
+                elevation[...] = np.nan
+                diverged = True
+            elif steadyTol is not None:
+                converged = np.max(np.abs(elevation - previous))/timeStep < steadyTol
+        
+        # store the year and the elevations, the steady state or the divergence ending the run 
+        
+        if iStep == keepSteps[iKeep] or converged or diverged:
+            years[iKeep] = iStep*timeStep
+            elevationArr[iKeep] = elevation
+            iKeep = iKeep + 1
+        
+        if converged or diverged:
+            break
+    
+    return(years[:iKeep], elevationArr[:iKeep])
+
+def IceSheetPlotLimit(IceSheetDF):
+    '''Returns the upper elevation limit of the ice sheet plots
+    
+
+    Parameters
+    ----------
+    IceSheetDF : numpy array
+        Data frame containing the different elevations values over the years.
+
+    Returns
+    -------
+    Largest elevation rounded up on its first digit.
+
+    '''
+    
+    # automatize plotLimit
+    
+    # delete NaN 
+    
+    maxVal = np.amax(IceSheetDF[~np.isnan(IceSheetDF).any(axis = 1)][:,1:])
+    
+    plotLimit = round(maxVal,-len(str(round(maxVal))) +1) + 10**(len(str(round(maxVal))) - 1)
+    
+    return(plotLimit)
 
 def IceSheetPlot(IceSheetDF):
     '''Returns animated plot of the ice sheet development over years
@@ -100,31 +759,125 @@ def IceSheetPlot(IceSheetDF):
     
     # initialize the plots 
     
-    # automatize plotLimit
+    plotLimit = IceSheetPlotLimit(IceSheetDF)
     
-    # delete NaN 
+    # define the plot, the line and the annotation are created once and then updated 
     
-    maxVal = np.amax(IceSheetDF[~np.isnan(IceSheetDF).any(axis = 1)][:,1:])
+    fig,ax =  plt.subplots()
     
-    plotLimit = round(maxVal,-len(str(round(maxVal))) +1) + 10**(len(str(round(maxVal))) - 1)
-        
+    ax.set_ylim([0,plotLimit])
+    ax.set_xlabel("nX")
+    ax.set_ylabel("Elevation (m)")
+    line, = ax.plot(IceSheetDF[0,1:])
+    text = ax.annotate("Year = " + str(IceSheetDF[0,0]), (0,plotLimit-500))
+
+    # define the animation, only the line and the annotation being redrawn 
+
+    def animate(i):
+        line.set_ydata(IceSheetDF[i,1:])
+        text.set_text("Year = " + str(IceSheetDF[i,0]))
+        return(line, text)
+
+    animator = ani.FuncAnimation(fig, animate, frames = (IceSheetDF.shape[0]), repeat = False, interval = 1, blit = True)
+
+    plt.show()
     
-    # define the plot 
+   
+def drawIceSheetFrame(fig,
+                      frame,
+                      plotLimit:float):
+    '''Draws one row of the ice sheet data frame on an empty figure, as a frame of IceSheetPlot
+    
+
+    Parameters
+    ----------
+    fig : matplotlib figure
+        Empty figure to draw on.
+    frame : numpy array
+        Row of the data frame with the year and the elevations.
+    plotLimit : float
+        Upper elevation limit of the plot.
+
+    Returns
+    -------
+    None.
+
+    '''
+    
+    ax = fig.add_subplot()
+    ax.set_ylim([0,plotLimit])
+    ax.set_xlabel("nX")
+    ax.set_ylabel("Elevation (m)")
+    ax.plot(frame[1:])
+    ax.annotate("Year = " + str(frame[0]), (0,plotLimit-500))
+
+def IceSheetExport(IceSheetDF,
+                   outputPath:str,
+                   nProcesses:int = None,
+                   fps:int = 25):
+    '''Renders the animation of IceSheetPlot offline over a process pool
+    
+    The frames are drawn without display, so this also works on headless servers and in IDEs 
+    where the animation does not.
+
+    Parameters
+    ----------
+    IceSheetDF : numpy array
+        Data frame containing the different elevations values over the years.
+    outputPath : str
+        Either a ".gif" or ".mp4" file, or a directory for a PNG sequence.
+    nProcesses : int
+        Number of worker processes. Default to the number of CPUs.
+    fps : int
+        Frames per second of the GIF or MP4 file.
+
+    Returns
+    -------
+    Number of frames rendered.
+
+    '''
+    
+    drawFrame = functools.partial(drawIceSheetFrame, plotLimit = IceSheetPlotLimit(IceSheetDF))
+    
+    return(AnimationExport.ExportFrames(drawFrame, IceSheetDF, outputPath, nProcesses = nProcesses, fps = fps))
+
+def IceSheet2DPlot(years,
+                   elevationArr):
+    '''Returns animated heatmap of the two dimensional ice sheet development over years
+    
+
+    Parameters
+    ----------
+    years : numpy array
+        Years of the kept elevations.
+    elevationArr : numpy array
+        Elevations over the years of shape (nKept, nY+2, nX+2), as given by IceSheet2DDF.
+
+    Returns
+    -------
+    Heatmap of elevation over years.
+
+    '''
+    
+    # the image and the annotation are created once and then updated 
     
     fig,ax =  plt.subplots()
     
+    image = ax.imshow(elevationArr[0], origin = "lower", vmin = 0, vmax = np.nanmax(elevationArr), 
+                      interpolation = "nearest")
+    fig.colorbar(image, ax = ax, label = "Elevation (m)")
+    ax.set_xlabel("nX")
+    ax.set_ylabel("nY")
+    text = ax.text(0.02, 0.95, "Year = " + str(years[0]), transform = ax.transAxes, color = "white")
 
     # define the animation 
 
     def animate(i):
-        ax.clear()
-        ax.set_ylim([0,plotLimit])
-        ax.set_xlabel("nX")
-        ax.set_ylabel("Elevation (m)")
-        plt.plot(IceSheetDF[i,1:])
-        plt.annotate("Year = " + str(IceSheetDF[i,0]), (0,plotLimit-500))
+        image.set_array(elevationArr[i])
+        text.set_text("Year = " + str(years[i]))
+        return(image, text)
 
-    animator = ani.FuncAnimation(fig, animate, frames = (IceSheetDF.shape[0]), repeat = False, interval = 1)
+    animator = ani.FuncAnimation(fig, animate, frames = len(years), repeat = False, interval = 1, blit = True)
 
     plt.show()
     
@@ -156,4 +909,13 @@ if __name__ == "__main__":
     
     # get the last resulst 
     
-    print(res[-1,1 + round(nX/2)])
\ No newline at end of file
+    print(res[-1,1 + round(nX/2)])
+    
+    # compare with the analytic steady state 
+    
+    steady = IceSheetSteady(nX = nX,
+                            domainWidth=domainWidth,
+                            flowParam=flowParam,
+                            snowFall=snowFall)
+    
+    print(steady[round(nX/2)])
\ No newline at end of file
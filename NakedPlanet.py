@@ -3,6 +3,106 @@
 import numpy as np
 import matplotlib.pyplot as plt 
 
+# create a generator streaming the time, temperature and IR heat of the planet 
+
+def TemperatureGen(TimeStep: float, 
+                   WaterDepth: int, 
+                   L: int, 
+                   albedo: float, 
+                   epsilon: float, 
+                   nSteps: int,
+                   TempIni: float,
+                   chunkSize: int = None):
+    '''Yields the time, temperature and the IR heat from the planet step by step or chunk by chunk
+    
+
+    Parameters
+    ----------
+    TimeStep : float
+        Time step you want to take in years.
+    WaterDepth : integer or array
+        The mediunm depth of the Water in m.
+    L : integer or array
+        Solar energy constant in W.m-2.
+    albedo : float or array
+        albedo reflecting planet energy reflection due to atmosphere layers. Float between 0 and 1
+    epsilon : float or array
+        emissivity reflecting the energy emmission of a body regarding the emission of a black body. Float between 0 and 1.
+    nSteps : integer
+        The number of time steps you are taking.
+    TempIni : integer or array
+        The initial temperature
+    chunkSize : integer
+        If None, yields one (time, temperature, IR heat) tuple per step. Otherwise yields numpy arrays 
+        of at most chunkSize rows with the same columns as TemperatureDF.
+
+    Yields
+    ------
+    The nSteps+1 values of time, temperature and IR heat form the planet, starting with the initial state.
+    If any of WaterDepth, L, albedo, epsilon or TempIni is an array, they are broadcast together and each 
+    member of the flattened broadcast is an ensemble member: temperatures and IR heats are then arrays 
+    of nMembers values and the chunks have the shape (nMembers, rows, 3).
+
+    '''
+    
+    # define stefan boltzman constant
+    
+    sigma = 5.67E-8 # W.m-2.K-4
+    
+    # broadcast the parameters over the ensemble members, a single run stays on python floats 
+    
+    WaterDepth, L, albedo, epsilon, TempIni = np.broadcast_arrays(WaterDepth, L, albedo, epsilon, TempIni)
+    
+    if WaterDepth.ndim == 0:
+        memberShape = ()
+        WaterDepth, L, albedo, epsilon, TempIni = [float(p) for p in (WaterDepth, L, albedo, epsilon, TempIni)]
+    else:
+        memberShape = (WaterDepth.size,)
+        WaterDepth, L, albedo, epsilon, TempIni = [p.ravel().astype(float) for p in (WaterDepth, L, albedo, epsilon, TempIni)]
+    
+    # define the palnet heat capacity and the incoming heat 
+    
+    HeatCapacity = 4200000*WaterDepth
+    HeatIn = L*(1-albedo)/4
+    HeatContent = HeatCapacity * TempIni
+    
+    # initial state 
+    
+    Time = 0
+    Temp = TempIni
+    HeatOut = epsilon*sigma*Temp**4
+    
+    # buffer used for the chunks 
+    
+    if chunkSize is not None:
+        chunk = np.empty(memberShape + (min(chunkSize, nSteps+1), 3))
+        iChunk = 0
+    
+    # perform the loop for the different time steps
+    
+    for i in range(nSteps+1):
+        
+        if i > 0:
+            Time = TimeStep*i
+            HeatContent = HeatContent + (HeatIn - HeatOut) * TimeStep * 3600*24*365
+            Temp = HeatContent/HeatCapacity
+            HeatOut = epsilon*sigma*Temp**4
+        
+        if chunkSize is None:
+            yield(Time, Temp, HeatOut)
+        else:
+            chunk[..., iChunk, 0] = Time
+            chunk[..., iChunk, 1] = Temp
+            chunk[..., iChunk, 2] = HeatOut
+            iChunk = iChunk + 1
+            
+            # yield the full chunk and start a new one 
+            
+            if iChunk == chunk.shape[-2]:
+                yield(chunk)
+                chunk = np.empty(memberShape + (min(chunkSize, nSteps-i), 3))
+                iChunk = 0
+
 # create a function to define the data frame 
 
 def TemperatureDF(TimeStep: float, 
@@ -19,6 +119,58 @@ def TemperatureDF(TimeStep: float,
     ----------
     TimeStep : float
         Time step you want to take in years.
+    WaterDepth : integer or array
+        The mediunm depth of the Water in m.
+    L : integer or array
+        Solar energy constant in W.m-2.
+    albedo : float or array
+        albedo reflecting planet energy reflection due to atmosphere layers. Float between 0 and 1
+    epsilon : float or array
+        emissivity reflecting the energy emmission of a body regarding the emission of a black body. Float between 0 and 1.
+    nSteps : integer
+        The number of time steps you are taking.
+    TempIni : integer or array
+        The initial temperature
+
+    Returns
+    -------
+    Numpy array with time, temperature and IR heat form the planet. If any of WaterDepth, L, albedo, epsilon 
+    or TempIni is an array, they are broadcast together and all the members are run in the same time loop, 
+    the array is then of shape (nMembers, nSteps+1, 3) with the members in the flattened broadcast order.
+
+    '''
+    
+    # the whole run fits in a single preallocated chunk of nSteps+1 rows 
+    
+    TemperatureArray = next(TemperatureGen(TimeStep, 
+                                           WaterDepth, 
+                                           L, 
+                                           albedo, 
+                                           epsilon, 
+                                           nSteps, 
+                                           TempIni, 
+                                           chunkSize = nSteps+1))
+    return(TemperatureArray)
+
+# create a function running until the temperature settles 
+
+def TemperatureConvergedDF(TimeStep: float, 
+                           WaterDepth: int, 
+                           L: int, 
+                           albedo: float, 
+                           epsilon: float, 
+                           nSteps: int,
+                           TempIni: float,
+                           tolerance: float = 1E-3,
+                           adaptive: bool = True,
+                           safety: float = 0.5):
+    '''Returns a data frame of the time, temperature and the IR heat from the planet, stopped once the temperature has settled
+    
+
+    Parameters
+    ----------
+    TimeStep : float
+        Time step you want to take in years. When adaptive, this is the largest time step allowed.
     WaterDepth : integer
         The mediunm depth of the Water in m.
     L : integer
@@ -28,44 +180,72 @@ def TemperatureDF(TimeStep: float,
     epsilon : float
         emissivity reflecting the energy emmission of a body regarding the emission of a black body. Float between 0 and 1.
     nSteps : integer
-        The number of time steps you are taking.
+        The maximum number of time steps you are taking.
     TempIni : integer
         The initial temperature
+    tolerance : float
+        The run stops once the temperature change of a step is below tolerance in K.
+    adaptive : boolean
+        Should the time step follow the local relaxation time HeatCapacity/(4*epsilon*sigma*T^3) ? 
+        The step is then safety times the relaxation time, bounded by TimeStep. T is at least the 
+        equilibrium temperature, so a cold start does not take a much longer step than the 
+        relaxation time of the equilibrium.
+    safety : float
+        Fraction of the relaxation time taken as time step. Below 1 the temperature relaxes without 
+        oscillating, above 2 it blows up.
 
     Returns
     -------
-    Numpy array with time, temperature and IR heat form the planet.
+    Numpy array with time, temperature and IR heat form the planet, the number of steps used and 
+    the final residual (the temperature change of the last step in K).
 
     '''
     
-    # define stefan boltzman constant
+    # define stefan boltzman constant and the number of seconds in a year
     
     sigma = 5.67E-8 # W.m-2.K-4
-    
-    # intitiate the different columns of the data frame 
-    Time = [0,]
-    Temp = [TempIni,]
-    HeatOut = [epsilon*sigma*Temp[-1]**4,]
-    
+    yearSec = 3600*24*365
     
     # define the palnet heat capacity and the incoming heat 
     
     HeatCapacity = 4200000*WaterDepth
     HeatIn = L*(1-albedo)/4
-    HeatContent = HeatCapacity * Temp[0]
+    HeatContent = HeatCapacity * TempIni
     
-    # perform the loop for the different time steps
+    # equilibrium temperature bounding the relaxation time of a cold planet 
+    
+    TempEq = (HeatIn/(epsilon*sigma))**0.25 if epsilon > 0 else 0
+    
+    # initiate the data frame with the maximum number of rows 
+    
+    TemperatureArray = np.empty((nSteps+1, 3))
+    TemperatureArray[0,:] = (0, TempIni, epsilon*sigma*TempIni**4)
+    
+    # perform the loop until the temperature change is below the tolerance 
     
-    for i in range(nSteps):
+    residual = np.inf
+    i = 0
+    
+    while i < nSteps and residual >= tolerance:
         
-        Time = np.append(Time, TimeStep*(i+1))
-        HeatContent = HeatContent + (HeatIn - HeatOut[-1]) * TimeStep * 3600*24*365
-        Temp = np.append(Temp, HeatContent/HeatCapacity)
-        HeatOut = np.append(HeatOut, epsilon*sigma*Temp[-1]**4)
-          
-    # create the data frame at the end and transpose it to have it in a regular way 
-    TemperatureArray = np.array([Time,Temp,HeatOut]).transpose()
-    return(TemperatureArray)
+        Time, Temp, HeatOut = TemperatureArray[i,:]
+        
+        # get the time step from the relaxation time in years 
+        
+        step = TimeStep
+        if adaptive:
+            cooling = 4*epsilon*sigma*max(Temp, TempEq)**3
+            if cooling > 0:
+                step = min(TimeStep, safety*HeatCapacity/cooling/yearSec)
+        
+        HeatContent = HeatContent + (HeatIn - HeatOut) * step * yearSec
+        newTemp = HeatContent/HeatCapacity
+        TemperatureArray[i+1,:] = (Time + step, newTemp, epsilon*sigma*newTemp**4)
+        
+        residual = abs(newTemp - Temp)
+        i = i + 1
+    
+    return(TemperatureArray[:i+1,:], i, residual)
 
 def plotTemp(TempArray):
     '''Returns a plot of temperature versus time 
@@ -115,4 +295,16 @@ if __name__ == "__main__":
     
     print(res[-1,1], res[-1,2])
     
+    # get the same equilibrium with adaptive time steps, stopping once settled 
+    
+    resConv, nStepsUsed, residual = TemperatureConvergedDF(1000, 
+                                                           WaterDepth, 
+                                                           L, 
+                                                           albedo, 
+                                                           epsilon, 
+                                                           nSteps, 
+                                                           TempIni)
+    
+    print(resConv[-1,1], nStepsUsed, residual)
+    
      
\ No newline at end of file
@@ -1,10 +1,341 @@
 # import libraries
 
+import concurrent.futures as cf
 import numpy as np
 import matplotlib.pyplot as plt
-import math
 plt.style.use('classic')
 
+def TemperatureRelaxation(TEq,
+                          yearStep:float,
+                          tResponseTime,
+                          TIni:float = 0):
+    '''Returns the temperature relaxing towards the equilibrium temperatures
+    
+    Solves the recurrence T[k] = T[k-1] + (TEq[k] - T[k-1])*yearStep/tResponseTime with whole-array 
+    operations. With r = 1 - yearStep/tResponseTime, T[k] = r^k*(TIni + sum of TEq[j]*(1-r)*r^-j), 
+    which is computed by blocks short enough for r^-j to stay bounded. The trajectories with r = 0, 
+    where tResponseTime equals yearStep, follow TEq. The years are on the last axis so several 
+    trajectories can be computed together.
+
+    Parameters
+    ----------
+    TEq : numpy array
+        Equilibrium temperatures, the first one being the one of TIni and not used.
+    yearStep : float
+        Step between two years.
+    tResponseTime : float or array
+        Response time of the temperature in years, broadcast over the leading axes of TEq.
+    TIni : float
+        Initial temperature.
+
+    Returns
+    -------
+    Array of the same shape as TEq with the temperatures.
+
+    '''
+    
+    TEq = np.asarray(TEq, dtype=float)
+    rate = yearStep/np.asarray(tResponseTime, dtype=float)[...,np.newaxis]
+    r = 1 - rate
+    nYears = TEq.shape[-1]
+    
+    TEvol = np.empty(np.broadcast_shapes(TEq.shape, r.shape))
+    TEvol[...,0] = TIni
+    
+    # the trajectories with r = 0 have no memory of the previous temperature, they are computed 
+    # with r = 1 to avoid dividing by 0 and then set to TEq
+    
+    noMemory = r == 0
+    rate = np.where(noMemory, 0, rate)
+    r = np.where(noMemory, 1, r)
+    
+    # length of the blocks for r^-j to stay below 1E8 
+    
+    logR = np.max(np.abs(np.log(np.abs(r))), initial=0)
+    blockLen = nYears if logR == 0 else max(int(np.log(1E8)/logR), 1)
+    
+    k0 = 1
+    while k0 < nYears:
+        k1 = min(k0 + blockLen, nYears)
+        j = np.arange(1, k1 - k0 + 1)
+        power = r**j
+        TEvol[...,k0:k1] = power*(TEvol[...,k0-1:k0] + np.cumsum(TEq[...,k0:k1]*rate/power, axis=-1))
+        k0 = k1
+    
+    TEvol[...,1:] = np.where(noMemory, TEq[...,1:], TEvol[...,1:])
+    
+    return(TEvol)
+
+# stages of the physics of a scenario, shared by NearFutureScenarios, NearFutureResult and NearFutureGradient.
+# The years are on the last axis, after is True for the years after the human emissions stopped.
+
+def ScenarioCO2BAS(k, yearStep:int, CO2Eq:int, CO2Beg:int, A):
+    '''Returns the business as usual CO2 of the year indices k, a geometric series'''
+    
+    return(CO2Eq + (CO2Beg - CO2Eq)*(1+A*yearStep)**k)
+
+def ScenarioCO2(CO2_BAS, k, idxStop, yearStep:int, CO2Eq:int, drawDown):
+    '''Returns the CO2 following CO2_BAS until the year index idxStop and then drawing down'''
+    
+    CO2Stop = np.take_along_axis(CO2_BAS, np.broadcast_to(idxStop, CO2_BAS.shape[:-1] + (1,)), axis=-1)
+    return(np.where(k > idxStop, CO2Eq + (CO2Stop - CO2Eq)*(1-drawDown*yearStep)**(k - idxStop), CO2_BAS))
+
+def ScenarioRFCO2(CO2_BAS, CO2Eq:int, climateSensitivity2X:float, CO2 = None, after = False):
+    '''Returns the CO2 forcing, using the business as usual CO2 of the previous year and the CO2 of the year after the stop'''
+    
+    RFCO2 = np.zeros(CO2_BAS.shape)
+    RFCO2[...,1:] = climateSensitivity2X*np.log(CO2_BAS[...,:-1]/CO2Eq)/np.log(2)
+    if CO2 is not None:
+        RFCO2 = np.where(after, climateSensitivity2X*np.log(CO2/CO2Eq)/np.log(2), RFCO2)
+    return(RFCO2)
+
+def ScenarioCO2Rate(CO2, yearStep:int):
+    '''Returns the CO2 rate of each year in ppm.year-1'''
+    
+    CO2Rate = np.zeros(CO2.shape)
+    CO2Rate[...,1:] = np.diff(CO2, axis=-1)/yearStep
+    return(CO2Rate)
+
+def ScenarioRFMasked(CO2Rate_BAS, idxToday:int, RFForcingToday, after = False):
+    '''Returns the aerosol masking forcing, B times the CO2 rate but at least RFForcingToday, and no masking after the stop'''
+    
+    B = RFForcingToday/CO2Rate_BAS[...,idxToday:idxToday+1]
+    RFMasked = np.zeros(CO2Rate_BAS.shape)
+    RFMasked[...,1:] = np.maximum(B*CO2Rate_BAS[...,1:], RFForcingToday)
+    return(np.where(after, 0, RFMasked))
+
+def ScenarioRFTot(RFCO2, RFMasked):
+    '''Returns the total forcing, zero the first year'''
+    
+    RFTot = RFCO2 + RFMasked
+    RFTot[...,0] = 0
+    return(RFTot)
+
+def ScenarioTEq(RFTot, climateSensitivityK, climateSensitivity2X:float):
+    '''Returns the equilibrium temperature raise of the total forcing'''
+    
+    return(climateSensitivityK/climateSensitivity2X*RFTot)
+
+# names of the variables of each scenario
+
+scenarioVariables = ("years", "CO2", "RFCO2", "CO2Rate", "RFMasked", "RFTot", "TEq", "TEvol")
+
+def NearFutureScenarios(yearBeg:int,
+                        yearEnd:int,
+                        yearStep:int,
+                        CO2Eq:int,
+                        CO2Beg:int,
+                        A,
+                        drawDown,
+                        climateSensitivityK,
+                        climateSensitivity2X:float,
+                        RFForcingToday,
+                        yearNow:int,
+                        tResponseTime,
+                        yearStop = np.inf):
+    '''Returns the CO2 and temperature raise of many emission scenarios computed together
+    
+    Each scenario follows the business as usual CO2 raise until its yearStop and then draws down 
+    without human emissions nor aerosol masking, as the no human scenario of NearFutureDF. A 
+    scenario with yearStop after yearEnd is a business as usual one.
+
+    Parameters
+    ----------
+    yearBeg : int
+        First year.
+    yearEnd : int
+        Last year.
+    yearStep : int
+        Step between two years.
+    CO2Eq : int
+        Equilibrium CO2 concentration in ppm.
+    CO2Beg : int
+        CO2 concentration of the first year in ppm.
+    A : float or array
+        Growth rate of the human CO2 in year-1.
+    drawDown : float or array
+        Draw down rate of the CO2 once the human emissions stopped in year-1.
+    climateSensitivityK : float or array
+        Temperature raise for a doubling of CO2 in K.
+    climateSensitivity2X : float
+        Radiative forcing for a doubling of CO2 in W.m-2.
+    RFForcingToday : float or array
+        Aerosol masking radiative forcing of yearNow in W.m-2, setting the masking coefficient B.
+    yearNow : int
+        Year of RFForcingToday, it has to be one of the years.
+    tResponseTime : float or array
+        Response time of the temperature in years.
+    yearStop : float or array
+        Year when the human emissions stop, np.inf for never. It is rounded up to the next year.
+
+    Returns
+    -------
+    Structured array of shape (nScenarios, nYears) with one field per name of scenarioVariables, 
+    so res["TEvol"] gives the temperatures of all the scenarios. res.view(float).reshape(nScenarios, 
+    nYears, -1) gives the same data as a (scenarios x years x variables) array. The array parameters 
+    are broadcast together and the scenarios are in the flattened broadcast order.
+
+    '''
+    
+    # broadcast the scenario parameters on a column, the years being on the last axis 
+    
+    params = np.broadcast_arrays(A, drawDown, climateSensitivityK, RFForcingToday, tResponseTime, yearStop)
+    A, drawDown, climateSensitivityK, RFForcingToday, tResponseTime, yearStop = [p.reshape(-1,1).astype(float) for p in params]
+    nScenarios = A.shape[0]
+    
+    # define the years 
+    
+    nSteps = int((yearEnd-yearBeg)/yearStep)
+    k = np.arange(nSteps+1)
+    years = yearBeg + k*yearStep
+    
+    idxToday = np.where(np.isclose(years, yearNow))[0]
+    if len(idxToday) == 0:
+        print("yearNow should be one of the years.")
+        return(None)
+    idxToday = idxToday[0]
+    
+    idxStop = np.clip(np.ceil((yearStop - yearBeg)/yearStep - 1E-9), 0, nSteps).astype(int)
+    after = k > idxStop
+    
+    # the business as usual CO2 raise is a geometric series, its forcing uses the CO2 of the previous year
+    
+    CO2_BAS = ScenarioCO2BAS(k, yearStep, CO2Eq, CO2Beg, A)
+    CO2Rate_BAS = ScenarioCO2Rate(CO2_BAS, yearStep)
+    
+    # after yearStop the CO2 draws down and there is no more masking 
+    
+    res = np.zeros((nScenarios, nSteps+1), dtype=[(name, float) for name in scenarioVariables])
+    res["years"] = years
+    res["CO2"] = ScenarioCO2(CO2_BAS, k, idxStop, yearStep, CO2Eq, drawDown)
+    res["RFCO2"] = ScenarioRFCO2(CO2_BAS, CO2Eq, climateSensitivity2X, res["CO2"], after)
+    res["CO2Rate"] = ScenarioCO2Rate(res["CO2"], yearStep)
+    res["RFMasked"] = ScenarioRFMasked(CO2Rate_BAS, idxToday, RFForcingToday, after)
+    res["RFTot"] = ScenarioRFTot(res["RFCO2"], res["RFMasked"])
+    res["TEq"] = ScenarioTEq(res["RFTot"], climateSensitivityK, climateSensitivity2X)
+    
+    # calulate the temperature 
+    
+    res["TEvol"] = TemperatureRelaxation(res["TEq"], yearStep, tResponseTime[:,0])
+    
+    return(res)
+
+# names of the columns of NearFutureDF
+
+NearFutureColumns = ("years", "CO2_BAS", "RFCO2_BAS", "CO2Rate_BAS", "RFMasked_BAS", "RFTot_BAS", "TEq_BAS", "TEvol_BAS",
+                     "CO2_NH", "RFCO2_NH", "RFMasked_NH", "RFTot_NH", "TEq_NH", "TEvol_NH", "TDiff")
+
+class NearFutureResult:
+    '''Columns of NearFutureDF computed on first access
+    
+    The columns are stored in one (nYears, 15) buffer and each one is computed, with the columns 
+    it depends on, the first time it is read, with the same stages as NearFutureScenarios. 
+    res["TDiff"] or res.TDiff gives a read only column, and any other index, e.g. res[:,7], or 
+    np.asarray(res) computes all the columns and indexes a read only view of the buffer.
+    
+    '''
+    
+    def __init__(self, years, idxToday, yearStep, CO2Eq, CO2Beg, A, drawDown, climateSensitivityK, 
+                 climateSensitivity2X, RFForcingToday, yearNow, tResponseTime):
+        
+        self.yearNow = yearNow
+        self.yearStep = yearStep
+        self.CO2Eq = CO2Eq
+        self.CO2Beg = CO2Beg
+        self.A = A
+        self.drawDown = drawDown
+        self.climateSensitivityK = climateSensitivityK
+        self.climateSensitivity2X = climateSensitivity2X
+        self.RFForcingToday = RFForcingToday
+        self.tResponseTime = tResponseTime
+        self.idxToday = idxToday
+        self.k = np.arange(len(years))
+        self.after = self.k > idxToday
+        
+        self.data = np.zeros((len(years), len(NearFutureColumns)))
+        self.data[:,0] = years
+        self.computed = {"years"}
+    
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in NearFutureColumns:
+                raise KeyError(key)
+            iCol = NearFutureColumns.index(key)
+            if key not in self.computed:
+                self.data[:,iCol] = getattr(self, "compute" + key)()
+                self.computed.add(key)
+            column = self.data[:,iCol].view()
+            column.flags.writeable = False
+            return(column)
+        return(np.asarray(self)[key])
+    
+    def __getattr__(self, name):
+        if name in NearFutureColumns:
+            return(self[name])
+        raise AttributeError(name)
+    
+    def __array__(self, dtype=None, copy=None):
+        for name in NearFutureColumns:
+            self[name]
+        if copy or dtype is not None:
+            return(np.array(self.data, dtype=dtype))
+        data = self.data.view()
+        data.flags.writeable = False
+        return(data)
+    
+    def __len__(self):
+        return(self.data.shape[0])
+    
+    @property
+    def shape(self):
+        return(self.data.shape)
+    
+    # business as usual: the human emissions never stop
+    
+    def computeCO2_BAS(self):
+        return(ScenarioCO2BAS(self.k, self.yearStep, self.CO2Eq, self.CO2Beg, self.A))
+    
+    def computeRFCO2_BAS(self):
+        return(ScenarioRFCO2(self["CO2_BAS"], self.CO2Eq, self.climateSensitivity2X))
+    
+    def computeCO2Rate_BAS(self):
+        return(ScenarioCO2Rate(self["CO2_BAS"], self.yearStep))
+    
+    def computeRFMasked_BAS(self):
+        return(ScenarioRFMasked(self["CO2Rate_BAS"], self.idxToday, self.RFForcingToday))
+    
+    def computeRFTot_BAS(self):
+        return(ScenarioRFTot(self["RFCO2_BAS"], self["RFMasked_BAS"]))
+    
+    def computeTEq_BAS(self):
+        return(ScenarioTEq(self["RFTot_BAS"], self.climateSensitivityK, self.climateSensitivity2X))
+    
+    def computeTEvol_BAS(self):
+        return(TemperatureRelaxation(self["TEq_BAS"], self.yearStep, self.tResponseTime))
+    
+    # no human: the human emissions stop at yearNow
+    
+    def computeCO2_NH(self):
+        return(ScenarioCO2(self["CO2_BAS"], self.k, self.idxToday, self.yearStep, self.CO2Eq, self.drawDown))
+    
+    def computeRFCO2_NH(self):
+        return(ScenarioRFCO2(self["CO2_BAS"], self.CO2Eq, self.climateSensitivity2X, self["CO2_NH"], self.after))
+    
+    def computeRFMasked_NH(self):
+        return(ScenarioRFMasked(self["CO2Rate_BAS"], self.idxToday, self.RFForcingToday, self.after))
+    
+    def computeRFTot_NH(self):
+        return(ScenarioRFTot(self["RFCO2_NH"], self["RFMasked_NH"]))
+    
+    def computeTEq_NH(self):
+        return(ScenarioTEq(self["RFTot_NH"], self.climateSensitivityK, self.climateSensitivity2X))
+    
+    def computeTEvol_NH(self):
+        return(TemperatureRelaxation(self["TEq_NH"], self.yearStep, self.tResponseTime))
+    
+    def computeTDiff(self):
+        return(self["TEvol_BAS"] - self["TEvol_NH"])
+
 def NearFutureDF(yearBeg:int,
                  yearEnd:int,
                  yearStep:int,
@@ -17,98 +348,585 @@ def NearFutureDF(yearBeg:int,
                  RFForcingToday:float,
                  yearNow:int,
                  tResponseTime:int):
+    '''Returns DF of the CO2 and temperature raise for the business as usual and the no human emission scenarios
+    
+
+    Parameters
+    ----------
+    yearBeg : int
+        First year.
+    yearEnd : int
+        Last year.
+    yearStep : int
+        Step between two years.
+    CO2Eq : int
+        Equilibrium CO2 concentration in ppm.
+    CO2Beg : int
+        CO2 concentration of the first year in ppm.
+    A : float
+        Growth rate of the human CO2 in year-1.
+    drawDown : float
+        Draw down rate of the CO2 once the human emissions stopped in year-1.
+    climateSensitivityK : float
+        Temperature raise for a doubling of CO2 in K.
+    climateSensitivity2X : float
+        Radiative forcing for a doubling of CO2 in W.m-2.
+    RFForcingToday : float
+        Aerosol masking radiative forcing of yearNow in W.m-2.
+    yearNow : int
+        Year when the human emissions stop in the no human scenario, it has to be one of the years.
+    tResponseTime : int
+        Response time of the temperature in years.
+
+    Returns
+    -------
+    NearFutureResult with the columns of NearFutureColumns, computed on first access: years, CO2_BAS, 
+    RFCO2_BAS, CO2Rate_BAS, RFMasked_BAS, RFTot_BAS, TEq_BAS, TEvol_BAS, CO2_NH, RFCO2_NH, RFMasked_NH, 
+    RFTot_NH, TEq_NH, TEvol_NH and TDiff. Indexed by position it behaves as the (nYears, 15) array.
+
+    '''
     
-    # initialize the different columns of the DF 
+    # define the years 
     
-    years = [yearBeg,]
-    CO2_BAS = [CO2Beg,]
-    RFCO2_BAS = [0,]
-    CO2Rate_BAS = [0,]
-    RFMasked_BAS = [0,]
-    RFTot_BAS = [0,]
-    TEq_BAS = [0,]
-    TEvol_BAS = [0,]
-    CO2_NH = [CO2Beg,]
-    RFCO2_NH = [0,]
-    RFMasked_NH = [0,]
-    RFTot_NH = [0,]
-    TEq_NH = [0.]
-    TEvol_NH = [0,]
+    nSteps = int((yearEnd-yearBeg)/yearStep)
+    years = yearBeg + np.arange(nSteps+1)*yearStep
     
-    # create a loop over years and calulate the CO2 raise in the business as usual scenario
+    idxToday = np.where(np.isclose(years, yearNow))[0]
+    if len(idxToday) == 0:
+        print("yearNow should be one of the years.")
+        return(None)
     
-    for i in range(int((yearEnd-yearBeg)/yearStep)):
-        years = np.append(years, years[-1] + yearStep)
-        CO2_BAS = np.append(CO2_BAS, CO2Eq + (CO2_BAS[-1] - CO2Eq)*(1+A*yearStep))
-        RFCO2_BAS = np.append(RFCO2_BAS, climateSensitivity2X*math.log(CO2_BAS[i]/CO2Eq)/math.log(2))
-        CO2Rate_BAS = np.append(CO2Rate_BAS, (CO2_BAS[-1]-CO2_BAS[-2])/yearStep)
+    return(NearFutureResult(years, idxToday[0], yearStep, CO2Eq, CO2Beg, A, drawDown, climateSensitivityK,
+                            climateSensitivity2X, RFForcingToday, yearNow, tResponseTime))
 
+# names of the ensemble variables 
+
+ensembleVariables = ("TEvol_BAS", "TEvol_NH", "TDiff")
+
+def EnsembleSample(rng,
+                   distribution,
+                   nMembers:int):
+    '''Returns nMembers values of a parameter 
     
-    # calculate B 
+
+    Parameters
+    ----------
+    rng : numpy Generator
+        Random generator.
+    distribution : float or tuple
+        Either a fixed value, or a tuple (name, *args) of a numpy Generator method and its 
+        arguments, e.g. ("normal", 3, 1) or ("uniform", 10, 30).
+    nMembers : int
+        Number of values.
+
+    Returns
+    -------
+    Array of nMembers values.
+
+    '''
     
-    idxToday = np.where(years== yearNow)[0]
-    B = RFForcingToday/CO2Rate_BAS[idxToday]
+    if isinstance(distribution, tuple):
+        return(getattr(rng, distribution[0])(*distribution[1:], size=nMembers))
+    return(np.full(nMembers, float(distribution)))
+
+def EnsembleCounts(TEvol,
+                   lower,
+                   upper,
+                   nBins:int):
+    '''Returns the histograms of the members of each variable and year
     
-    # continue the time loop using the B value 
+
+    Parameters
+    ----------
+    TEvol : numpy array
+        Values of shape (nMembers, 3, nYears).
+    lower : numpy array
+        Lower bound of the histograms, of shape (3, nYears).
+    upper : numpy array
+        Upper bound of the histograms, of shape (3, nYears).
+    nBins : int
+        Number of bins, with one more bin on each side for the values out of bounds.
+
+    Returns
+    -------
+    Counts of shape (3, nYears, nBins+2).
+
+    '''
     
-    for i in range(int((yearEnd-yearBeg)/yearStep)):
-        RFMasked_BAS = np.append(RFMasked_BAS, max(B*CO2Rate_BAS[i+1],RFForcingToday))
-        RFTot_BAS = np.append(RFTot_BAS, RFCO2_BAS[i+1] + RFMasked_BAS[i+1])
-        TEq_BAS = np.append(TEq_BAS, climateSensitivityK/climateSensitivity2X*RFTot_BAS[i+1])
-        TEvol_BAS = np.append(TEvol_BAS,TEvol_BAS[-1]+(TEq_BAS[-1]-TEvol_BAS[-1])*yearStep/tResponseTime)
-        
-        # create the loop for the non human scenario 
-        
-        if i < idxToday:
-            CO2_NH = np.append(CO2_NH, CO2_BAS[i+1])
-            RFCO2_NH = np.append(RFCO2_NH, RFCO2_BAS[i+1])
-            RFMasked_NH = np.append(RFMasked_NH, RFMasked_BAS[i+1])
-            RFTot_NH = np.append(RFTot_NH, RFTot_BAS[i+1])
-        else:
-            CO2_NH = np.append(CO2_NH, CO2_NH[-1] + (CO2Eq - CO2_NH[-1])*drawDown*yearStep)
-            RFCO2_NH = np.append(RFCO2_NH, climateSensitivity2X*math.log(CO2_NH[i+1]/CO2Eq)/math.log(2))
-            RFMasked_NH = np.append(RFMasked_NH, 0)
-            RFTot_NH = np.append(RFTot_NH, RFCO2_NH[i+1])
+    # count the members of each bin with a single bincount over all the variables and years
+    
+    idx = np.floor((TEvol - lower)/(upper - lower)*nBins)
+    idx = np.clip(idx, -1, nBins).astype(int) + 1
+    offset = np.arange(lower.size).reshape(lower.shape)*(nBins+2)
+    counts = np.bincount((idx + offset).ravel(), minlength=lower.size*(nBins+2))
+    
+    return(counts.reshape(lower.shape + (nBins+2,)))
+
+def EnsembleChunk(model:dict,
+                  distributions:dict,
+                  seed,
+                  nMembers:int,
+                  lower = None,
+                  upper = None,
+                  nBins:int = 1000):
+    '''Returns the statistics of a chunk of ensemble members computed together
+    
+
+    Parameters
+    ----------
+    model : dict
+        Fixed parameters of NearFutureScenarios.
+    distributions : dict
+        Distribution of climateSensitivityK, tResponseTime, RFForcingToday, A and drawDown, see 
+        EnsembleSample.
+    seed : numpy SeedSequence
+        Seed of the random generator of the chunk.
+    nMembers : int
+        Number of members of the chunk.
+    lower : numpy array
+        Lower bound of the histograms, of shape (3, nYears). Default to no histograms.
+    upper : numpy array
+        Upper bound of the histograms, of shape (3, nYears).
+    nBins : int
+        Number of bins of the histograms, with one more bin on each side for the values out of bounds.
+
+    Returns
+    -------
+    Dictionary with the number of members n, and for each variable of ensembleVariables and year 
+    the sum, the sum of squares, the minimum, the maximum and the histogram counts. Without bounds 
+    it also returns the values as TEvol.
+
+    '''
+    
+    rng = np.random.default_rng(seed)
+    params = {name: EnsembleSample(rng, distributions[name], nMembers)[:,np.newaxis]
+              for name in ("climateSensitivityK", "tResponseTime", "RFForcingToday", "A", "drawDown")}
+    
+    # the members are on the first axis and the two scenarios on the second one 
+    
+    res = NearFutureScenarios(**model, **params, yearStop=[np.inf, model["yearNow"]])
+    TEvol = res["TEvol"].reshape(nMembers, 2, -1)
+    TEvol = np.stack((TEvol[:,0], TEvol[:,1], TEvol[:,0] - TEvol[:,1]), axis=1)
+    
+    stats = {"n": nMembers,
+             "sum": TEvol.sum(axis=0),
+             "sumSq": (TEvol**2).sum(axis=0),
+             "min": TEvol.min(axis=0),
+             "max": TEvol.max(axis=0)}
+    
+    if lower is None:
+        stats["TEvol"] = TEvol
+        return(stats)
+    
+    stats["counts"] = EnsembleCounts(TEvol, lower, upper, nBins)
+    
+    return(stats)
+
+def NearFutureEnsemble(yearBeg:int,
+                       yearEnd:int,
+                       yearStep:int,
+                       CO2Eq:int,
+                       CO2Beg:int,
+                       climateSensitivity2X:float,
+                       yearNow:int,
+                       distributions:dict,
+                       nMembers:int,
+                       quantiles = (0.05, 0.5, 0.95),
+                       chunkSize:int = 10000,
+                       nBins:int = 1000,
+                       nProcesses:int = None,
+                       seed:int = None):
+    '''Returns per year mean and quantiles of the temperature raise of a Monte Carlo ensemble
+    
+    The members are computed by chunks with NearFutureScenarios, and only the running sums and 
+    the histograms of each year are kept. The bounds of the histograms are set from the first 
+    chunk, with a margin, and the quantiles are interpolated inside the bins, so their error is 
+    about the bin width. Each chunk has its own seed, so the result does not depend on nProcesses.
+
+    Parameters
+    ----------
+    yearBeg : int
+        First year.
+    yearEnd : int
+        Last year.
+    yearStep : int
+        Step between two years.
+    CO2Eq : int
+        Equilibrium CO2 concentration in ppm.
+    CO2Beg : int
+        CO2 concentration of the first year in ppm.
+    climateSensitivity2X : float
+        Radiative forcing for a doubling of CO2 in W.m-2.
+    yearNow : int
+        Year of RFForcingToday and of the emission stop, it has to be one of the years.
+    distributions : dict
+        Distribution of climateSensitivityK, tResponseTime, RFForcingToday, A and drawDown. Each one 
+        is a fixed value or a tuple (name, *args) of a numpy Generator method, e.g. ("normal", 3, 1).
+    nMembers : int
+        Number of members.
+    quantiles : tuple
+        Quantiles to compute, between 0 and 1.
+    chunkSize : int
+        Number of members computed together.
+    nBins : int
+        Number of bins of the histograms of each year.
+    nProcesses : int
+        Number of worker processes. Default to computing the chunks in this process.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    Structured array of shape (2 + len(quantiles), nYears) with the fields years and the ones 
+    of ensembleVariables. The rows are the mean, the standard deviation and the quantiles, so 
+    res["TDiff"][2] is the first quantile of the temperature difference.
+
+    '''
+    
+    model = {"yearBeg": yearBeg, "yearEnd": yearEnd, "yearStep": yearStep, "CO2Eq": CO2Eq, 
+             "CO2Beg": CO2Beg, "climateSensitivity2X": climateSensitivity2X, "yearNow": yearNow}
+    
+    years = yearBeg + np.arange(int((yearEnd-yearBeg)/yearStep)+1)*yearStep
+    if not np.isclose(years, yearNow).any():
+        print("yearNow should be one of the years.")
+        return(None)
+    
+    sizes = [chunkSize]*(nMembers//chunkSize)
+    if nMembers % chunkSize > 0:
+        sizes.append(nMembers % chunkSize)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    
+    # the first chunk sets the bounds of the histograms 
+    
+    first = EnsembleChunk(model, distributions, seeds[0], sizes[0])
+    span = first["max"] - first["min"]
+    span = np.where(span > 0, span, 1E-6)
+    lower = first["min"] - 0.5*span
+    upper = first["max"] + 0.5*span
+    
+    total = {"n": first["n"], "sum": first["sum"], "sumSq": first["sumSq"], "min": first["min"], 
+             "max": first["max"], "counts": EnsembleCounts(first["TEvol"], lower, upper, nBins)}
+    
+    def merge(stats):
+        total["n"] = total["n"] + stats["n"]
+        total["sum"] = total["sum"] + stats["sum"]
+        total["sumSq"] = total["sumSq"] + stats["sumSq"]
+        total["min"] = np.minimum(total["min"], stats["min"])
+        total["max"] = np.maximum(total["max"], stats["max"])
+        total["counts"] = total["counts"] + stats["counts"]
+    
+    # compute the other chunks, here or over a process pool 
+    
+    if nProcesses is None:
+        for seedChunk, size in zip(seeds[1:], sizes[1:]):
+            merge(EnsembleChunk(model, distributions, seedChunk, size, lower, upper, nBins))
+    else:
+        with cf.ProcessPoolExecutor(max_workers=nProcesses) as pool:
+            pending = set()
+            for seedChunk, size in zip(seeds[1:], sizes[1:]):
+                if len(pending) >= 2*nProcesses:
+                    done, pending = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+                    for f in done:
+                        merge(f.result())
+                pending.add(pool.submit(EnsembleChunk, model, distributions, seedChunk, size, lower, upper, nBins))
+            for f in cf.as_completed(pending):
+                merge(f.result())
+    
+    # mean and standard deviation from the running sums 
+    
+    n = total["n"]
+    mean = total["sum"]/n
+    std = np.sqrt(np.maximum(total["sumSq"]/n - mean**2, 0))
+    
+    # quantiles by linear interpolation in the cumulated histograms, the outer bins going to the extreme values
+    
+    width = (upper - lower)/nBins
+    edges = lower[...,np.newaxis] + width[...,np.newaxis]*np.arange(nBins+1)
+    edges = np.concatenate((np.minimum(total["min"], lower)[...,np.newaxis], edges, 
+                            np.maximum(total["max"], upper)[...,np.newaxis]), axis=-1)
+    cumCounts = np.cumsum(total["counts"], axis=-1)
+    
+    res = np.zeros((2 + len(quantiles), len(years)), dtype=[(name, float) for name in ("years",) + ensembleVariables])
+    res["years"] = years
+    for j, name in enumerate(ensembleVariables):
+        res[name][0] = mean[j]
+        res[name][1] = std[j]
+    
+    for i, q in enumerate(quantiles):
+        target = q*n
+        iBin = np.minimum((cumCounts < target).sum(axis=-1), nBins+1)
+        iBin = iBin[...,np.newaxis]
+        inBin = np.take_along_axis(total["counts"], iBin, axis=-1)[...,0]
+        before = np.take_along_axis(cumCounts, iBin, axis=-1)[...,0] - inBin
+        frac = np.where(inBin > 0, (target - before)/np.maximum(inBin, 1), 0)
+        left = np.take_along_axis(edges, iBin, axis=-1)[...,0]
+        right = np.take_along_axis(edges, iBin+1, axis=-1)[...,0]
+        value = left + frac*(right - left)
+        for j, name in enumerate(ensembleVariables):
+            res[name][2+i] = value[j]
+    
+    return(res)
+
+# names of the calibrated parameters 
+
+calibrationParameters = ("A", "B", "climateSensitivityK", "tResponseTime")
+
+def NearFutureGradient(yearBeg:int,
+                       yearEnd:int,
+                       yearStep:int,
+                       CO2Eq:int,
+                       CO2Beg:int,
+                       A:float,
+                       B:float,
+                       climateSensitivityK:float,
+                       climateSensitivity2X:float,
+                       yearNow:int,
+                       tResponseTime:float):
+    '''Returns the business as usual temperature and its derivatives with respect to A, B, climateSensitivityK and tResponseTime
+    
+    The derivatives are propagated in forward mode through the recurrence. As the recurrence is 
+    linear in TEq, the derivatives with respect to A, B and climateSensitivityK are the relaxation 
+    of the derivatives of TEq. The derivative S with respect to tResponseTime follows the same 
+    relaxation towards -(TEq[k] - T[k-1])/tResponseTime.
+
+    Parameters
+    ----------
+    yearBeg : int
+        First year.
+    yearEnd : int
+        Last year.
+    yearStep : int
+        Step between two years.
+    CO2Eq : int
+        Equilibrium CO2 concentration in ppm.
+    CO2Beg : int
+        CO2 concentration of the first year in ppm.
+    A : float
+        Growth rate of the human CO2 in year-1.
+    B : float
+        Aerosol masking coefficient in W.m-2.year.ppm-1, the aerosol forcing of yearNow being 
+        B times the CO2 rate of yearNow.
+    climateSensitivityK : float
+        Temperature raise for a doubling of CO2 in K.
+    climateSensitivity2X : float
+        Radiative forcing for a doubling of CO2 in W.m-2.
+    yearNow : int
+        Year of the aerosol masking floor, it has to be one of the years.
+    tResponseTime : float
+        Response time of the temperature in years.
+
+    Returns
+    -------
+    years, the temperatures TEvol_BAS and their derivatives of shape (4, nYears) in the order of 
+    calibrationParameters.
+
+    '''
+    
+    # define the years 
+    
+    nSteps = int((yearEnd-yearBeg)/yearStep)
+    k = np.arange(nSteps+1)
+    years = yearBeg + k*yearStep
+    
+    idxToday = np.where(np.isclose(years, yearNow))[0]
+    if len(idxToday) == 0:
+        print("yearNow should be one of the years.")
+        return(None)
+    idxToday = idxToday[0]
+    
+    # CO2 and its derivative with respect to A 
+    
+    CO2 = ScenarioCO2BAS(k, yearStep, CO2Eq, CO2Beg, A)
+    dCO2 = (CO2Beg - CO2Eq)*k*yearStep*(1+A*yearStep)**(k-1)
+    
+    RFCO2 = ScenarioRFCO2(CO2, CO2Eq, climateSensitivity2X)
+    dRFCO2 = np.zeros(nSteps+1)
+    dRFCO2[1:] = climateSensitivity2X*dCO2[:-1]/CO2[:-1]/np.log(2)
+    
+    CO2Rate = ScenarioCO2Rate(CO2, yearStep)
+    dCO2Rate = ScenarioCO2Rate(dCO2, yearStep)
+    
+    # the masked forcing is B times the CO2 rate of the year or of yearNow, whichever is the largest forcing 
+    
+    masked = B*CO2Rate >= B*CO2Rate[idxToday]
+    rateMasked = np.where(masked, CO2Rate, CO2Rate[idxToday])
+    dRateMasked = np.where(masked, dCO2Rate, dCO2Rate[idxToday])
+    
+    RFTot = ScenarioRFTot(RFCO2, B*rateMasked)
+    TEq = ScenarioTEq(RFTot, climateSensitivityK, climateSensitivity2X)
+    
+    dTEq = np.zeros((4, nSteps+1))
+    dTEq[0] = climateSensitivityK/climateSensitivity2X*(dRFCO2 + B*dRateMasked)
+    dTEq[1] = climateSensitivityK/climateSensitivity2X*rateMasked
+    dTEq[2] = RFTot/climateSensitivity2X
+    dTEq[:,0] = 0
+    
+    # relax the temperature, then all the derivatives together
+    
+    TEvol = TemperatureRelaxation(TEq, yearStep, tResponseTime)
+    dTEq[3,1:] = -(TEq[1:] - TEvol[:-1])/tResponseTime
+    dTEvol = TemperatureRelaxation(dTEq, yearStep, tResponseTime)
+    
+    return(years, TEvol, dTEvol)
+
+def NearFutureCalibrate(yearObs,
+                        TObs,
+                        yearBeg:int,
+                        yearStep:int,
+                        CO2Eq:int,
+                        CO2Beg:int,
+                        climateSensitivity2X:float,
+                        yearNow:int,
+                        A:float,
+                        B:float,
+                        climateSensitivityK:float,
+                        tResponseTime:float,
+                        fit = calibrationParameters,
+                        maxIter:int = 50,
+                        tolerance:float = 1E-10):
+    '''Returns the parameters of the business as usual scenario fitted to an observed temperature anomaly series
+    
+    Minimizes the sum of squares of TEvol_BAS - TObs with a Levenberg-Marquardt method, the 
+    Jacobian coming from NearFutureGradient. The model is linearly interpolated at yearObs, and 
+    the anomalies should be relative to yearBeg, where the model temperature is 0.
+
+    Parameters
+    ----------
+    yearObs : numpy array
+        Years of the observations.
+    TObs : numpy array
+        Observed temperature anomalies in K.
+    yearBeg : int
+        First year.
+    yearStep : int
+        Step between two years.
+    CO2Eq : int
+        Equilibrium CO2 concentration in ppm.
+    CO2Beg : int
+        CO2 concentration of the first year in ppm.
+    climateSensitivity2X : float
+        Radiative forcing for a doubling of CO2 in W.m-2.
+    yearNow : int
+        Year of the aerosol masking floor, it has to be one of the years.
+    A : float
+        Initial growth rate of the human CO2 in year-1.
+    B : float
+        Initial aerosol masking coefficient in W.m-2.year.ppm-1.
+    climateSensitivityK : float
+        Initial temperature raise for a doubling of CO2 in K.
+    tResponseTime : float
+        Initial response time of the temperature in years.
+    fit : tuple
+        Names of the fitted parameters, the other ones staying at their initial value.
+    maxIter : int
+        Maximum number of iterations.
+    tolerance : float
+        Relative decrease of the sum of squares under which the fit has converged.
+
+    Returns
+    -------
+    Dictionary of A, B, climateSensitivityK, tResponseTime and the matching RFForcingToday to use 
+    in NearFutureDF, the root mean square residual and the number of model evaluations.
+
+    '''
+    
+    yearObs = np.asarray(yearObs, dtype=float)
+    TObs = np.asarray(TObs, dtype=float)
+    yearEnd = yearBeg + np.ceil((max(yearObs.max(), yearNow) - yearBeg)/yearStep - 1E-9)*yearStep
+    
+    model = {"yearBeg": yearBeg, "yearEnd": yearEnd, "yearStep": yearStep, "CO2Eq": CO2Eq, "CO2Beg": CO2Beg,
+             "climateSensitivity2X": climateSensitivity2X, "yearNow": yearNow}
+    iFit = [calibrationParameters.index(name) for name in fit]
+    
+    def evaluate(p):
+        out = NearFutureGradient(**model, **dict(zip(calibrationParameters, p)))
+        if out is None:
+            return(None)
+        years, TEvol, dTEvol = out
+        res = np.interp(yearObs, years, TEvol) - TObs
+        jac = np.array([np.interp(yearObs, years, dTEvol[i]) for i in iFit]).transpose()
+        return(res, jac)
+    
+    p = np.array([A, B, climateSensitivityK, tResponseTime], dtype=float)
+    out = evaluate(p)
+    if out is None:
+        return(None)
+    res, jac = out
+    cost = np.sum(res**2)
+    nEvals = 1
+    damping = 1E-3
+    
+    # Levenberg-Marquardt iterations, the damping being scaled by the diagonal of J^T J 
+    
+    for i in range(maxIter):
+        JTJ = jac.transpose() @ jac
+        grad = jac.transpose() @ res
+        diag = np.maximum(np.diag(JTJ), 1E-30)
         
-        # calulate the different temperature 
+        accepted = False
+        while not accepted and damping < 1E10:
+            step = np.linalg.solve(JTJ + damping*np.diag(diag), -grad)
+            pNew = p.copy()
+            pNew[iFit] = p[iFit] + step
+            
+            # reject steps leaving the domain of the model 
+            
+            if pNew[3] <= 0 or 1 + pNew[0]*yearStep <= 0:
+                damping = damping*4
+                continue
+            
+            resNew, jacNew = evaluate(pNew)
+            nEvals = nEvals + 1
+            costNew = np.sum(resNew**2)
+            
+            if np.isfinite(costNew) and costNew <= cost:
+                accepted = True
+            else:
+                damping = damping*4
         
-        TEq_NH = np.append(TEq_NH, climateSensitivityK/climateSensitivity2X*RFTot_NH[i+1])
-        TEvol_NH = np.append(TEvol_NH,TEvol_NH[-1]+(TEq_NH[-1]-TEvol_NH[-1])*yearStep/tResponseTime)
+        if not accepted:
+            break
         
-    TDiff = TEvol_BAS - TEvol_NH
-
-    out = np.vstack((years, CO2_BAS, RFCO2_BAS, CO2Rate_BAS, RFMasked_BAS, RFTot_BAS, TEq_BAS, TEvol_BAS,
-                     CO2_NH, RFCO2_NH, RFMasked_NH, RFTot_NH, TEq_NH, TEvol_NH, TDiff)).transpose()
+        converged = cost - costNew <= tolerance*cost
+        p, res, jac, cost = pNew, resNew, jacNew, costNew
+        damping = max(damping/3, 1E-12)
+        if converged:
+            break
     
+    # aerosol forcing of yearNow matching B, the CO2 rate of the year k being (CO2Beg - CO2Eq)*A*(1+A*yearStep)^(k-1)
     
-        
-    return(out)
+    params = dict(zip(calibrationParameters, p))
+    idxToday = round((yearNow - yearBeg)/yearStep)
+    params["RFForcingToday"] = params["B"]*(CO2Beg - CO2Eq)*params["A"]*(1 + params["A"]*yearStep)**(idxToday-1)
+    
+    return(params, np.sqrt(cost/len(TObs)), nEvals)
 
 def NearFuturePlot(DF,
                    yParam:str):
     
     # define the x valuesas years
     
-    x = DF[:,0]
+    x = DF["years"]
+    yearNow = DF.yearNow
     
     # define the y values regarding yparam
     
     if yParam == "CO2":
-        y1 = DF[:,1]
-        y2 = DF[:,8]
+        y1 = DF["CO2_BAS"]
+        y2 = DF["CO2_NH"]
         ylab = "C02 emission (ppm)"
         legend = ["Business as usual","Human emission stopped at " + str(yearNow)]
     elif yParam == "RF":
-        y1 = DF[:,5]
-        y2 = DF[:,4]
-        y3 = DF[:,11]
-        y4 = DF[:,10]
+        y1 = DF["RFTot_BAS"]
+        y2 = DF["RFMasked_BAS"]
+        y3 = DF["RFTot_NH"]
+        y4 = DF["RFMasked_NH"]
         ylab = "Radiative forcing (W.m-2)"
         legend = ["Business as usual: Total","Business as usual: Masked",
                   "Human emission stopped at " + str(yearNow) + ": Total","Human emission stopped at " + str(yearNow) + ": Masked"]
     elif yParam == "TemperatureRaise":
-        y1 = DF[:,7]
-        y2 = DF[:,13]
+        y1 = DF["TEvol_BAS"]
+        y2 = DF["TEvol_NH"]
         ylab = "Temperature Raise (K)"
         legend = ["Business as usual","Human emission stopped at " + str(yearNow)]
         
@@ -159,6 +977,6 @@ if __name__ == "__main__":
     
     
     
-    yearIdx = np.where(res[:,0] == yearNow)[0]
+    yearIdx = np.where(res["years"] == yearNow)[0]
     
-    print(res[yearIdx, 7])
\ No newline at end of file
+    print(res["TEvol_BAS"][yearIdx])
\ No newline at end of file
@@ -1,8 +1,10 @@
 """
 
-The first section of the code contains setup and initialization 
-information.  Leave it alone for now, and you can play with them later 
-after you get the code filled in and running without bugs.  
+Shallow water model of the ocean stream movement taking into account the
+Coriolis effect. The whole state of a run (grid, velocities, elevation and
+the work arrays of the time step) is held by a ShallowWaterModel object, so
+several independent runs can live in the same process. Running the file as
+a script does a plotted run with the parameters of the main section.
 
 """
 
@@ -13,266 +15,1280 @@ import numpy
 import matplotlib.pyplot as plt
 import matplotlib.ticker as tkr
 import math
+import functools
+import json
+import os
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+import AnimationExport
 
-# Grid and Variable Initialization -- stuff you might play around with
+class ShallowWaterModel:
+    '''Shallow water model on a nrow x ncol grid
 
-ncol = 10
-nSlices = 400
-ntAnim = 1000
-horizontalWrap = True
-interpolateRotation = True
-rotationScheme = "PlusMinus"
-windScheme = "curled"
-initialPerturbation = ""
-plotOutput = True
-arrowScale = 30
-textOutput = False
 
+    Parameters
+    ----------
+    ncol : int
+        Number of columns of the grid.
+    nrow : int
+        Number of rows of the grid. Default to ncol.
+    dT : float
+        Time step in seconds.
+    G : float
+        Gravity in m.s-2, artificially low to allow a long time step with
+        the explicit step methods. "semiImplicit" runs with 9.8.
+    rotMethod : string
+        "simple" to use the velocities on their own grid for the rotation
+        terms, anything else to interpolate them through the H grid.
+    rotationScheme : string
+        Rotation rate over the rows, either "WithLatitude", "PlusMinus",
+        "Uniform". Anything else means no rotation.
+    windScheme : string
+        Wind forcing over the rows, either "Curled" or "Uniform". Anything
+        else means no wind.
+    initialPerturbation : string
+        Initial elevation, either "Tower", "NSGradient" or "EWGradient".
+        Anything else means a flat ocean.
+    horizontalWrap : boolean
+        Should the domain be periodic east-west ? Otherwise there are walls.
+    ntAnim : int
+        Default number of time steps taken by step().
+    stepMethod : string
+        "vectorized" for the whole-array kernel, "loop" for the slow cell by
+        cell reference implementation, "semiImplicit" for the kernel treating
+        the gravity waves implicitly, stable for large G or dT.
+    HBackground : float
+        Background depth of the ocean in meters.
+    dX : float
+        Grid step in meters, small enough to respond quickly. This is a very
+        small ocean on a very small, low-G planet.
+    dragConst : float
+        Drag constant in s-1, 1E-6 is about 10 days decay time.
+    meanLatitude : float
+        Mean latitude of the grid in degrees, used by "WithLatitude".
+    implicitWeight : float
+        Weight of the new time step in the gravity terms of "semiImplicit",
+        between 0.5 (centered, no damping) and 1 (backward, damping the
+        fastest waves).
+    nProcesses : int
+        Number of worker processes of the "vectorized" method, each one
+        stepping a strip of rows. Default to stepping in this process. The
+        workers are started on the first step and stopped by close(), at the
+        end of a with block, when the diagnostics abort the run or when run()
+        fails. A model collected without being closed still stops them and
+        unlinks the shared memory.
+    diagnostics : ShallowWaterDiagnostics
+        Optional diagnostics recorded every diagnostics.every time steps.
+        The model stops stepping if they ask to abort.
 
-dT = 600    # seconds
-G = 9.8e-4  # artificially low to allow a long time step
+    '''
 
-nrow = ncol
+    def __init__(self,
+                 ncol: int = 10,
+                 nrow: int = None,
+                 dT: float = 600,
+                 G: float = 9.8e-4,
+                 rotMethod: str = "simple",
+                 rotationScheme: str = "PlusMinus",
+                 windScheme: str = "curled",
+                 initialPerturbation: str = "",
+                 horizontalWrap: bool = True,
+                 ntAnim: int = 1000,
+                 stepMethod: str = "vectorized",
+                 HBackground: float = 4000,
+                 dX: float = 10.E3,
+                 dragConst: float = 1.E-6,
+                 meanLatitude: float = 30,
+                 implicitWeight: float = 0.6,
+                 nProcesses: int = None,
+                 diagnostics = None):
 
-# Note: the rotation rate gradient is more intense than the real world, so that
-# the model can equilibrate quickly.
+        # define the grid and the constants
 
-rotMethod = "simple"
+        if nrow is None:
+            nrow = ncol
+        self.ncol = ncol
+        self.nrow = nrow
+        self.dT = dT
+        self.G = G
+        self.flowConst = G  # 1/s2
+        self.rotMethod = rotMethod
+        self.rotationScheme = rotationScheme
+        self.windScheme = windScheme
+        self.initialPerturbation = initialPerturbation
+        self.horizontalWrap = horizontalWrap
+        self.ntAnim = ntAnim
+        self.stepMethod = stepMethod
+        self.HBackground = HBackground
+        self.dX = dX
+        self.dragConst = dragConst
+        self.meanLatitude = meanLatitude
+        self.implicitWeight = implicitWeight
+        self.helmholtzDenom = None
+        self.nProcesses = nProcesses
+        self.workers = None
+        self.diagnostics = diagnostics
+        self.aborted = False
 
-HBackground = 4000 # meters
+        # Note: the rotation rate gradient is more intense than the real world, so that
+        # the model can equilibrate quickly.
 
-dX = 10.E3 # meters, small enough to respond quickly.  This is a very small ocean
-# on a very small, low-G planet.  
+        dxDegrees = dX / 110.e3
 
-dxDegrees = dX / 110.e3
-flowConst = G  # 1/s2
-dragConst = 1.E-6  # about 10 days decay time
-meanLatitude = 30 # degrees
+        self.latitude = []
+        rotConst = []
+        windU = []
+        for irow in range(0,nrow):
+            if rotationScheme == "WithLatitude":
+                self.latitude.append( meanLatitude + (irow - nrow/2) * dxDegrees )
+                rotConst.append( -7.e-5 * math.sin(math.radians(self.latitude[-1]))) # s-1
+            elif rotationScheme == "PlusMinus":
+                rotConst.append( -3.5e-5 * (1. - 0.8 * ( irow - (nrow-1)/2 ) / nrow )) # rot 50% +-
+            elif rotationScheme == "Uniform":
+                rotConst.append( -3.5e-5 )
+            else:
+                rotConst.append( 0 )
 
-# Here's stuff you probably won't need to change
+            if windScheme == "Curled":
+                windU.append( 1e-8 * math.sin( (irow+0.5)/nrow * 2 * 3.14 ) )
+            elif windScheme == "Uniform":
+                windU.append( 1.e-8 )
+            else:
+                windU.append( 0 )
+        self.rotConst = numpy.array(rotConst, dtype=float)
+        self.windU = numpy.array(windU, dtype=float)
 
-latitude = []
-rotConst = []
-windU = []
-for irow in range(0,nrow):
-    if rotationScheme is "WithLatitude":
-        latitude.append( meanLatitude + (irow - nrow/2) * dxDegrees )
-        rotConst.append( -7.e-5 * math.sin(math.radians(latitude[-1]))) # s-1
-    elif rotationScheme is "PlusMinus":
-        rotConst.append( -3.5e-5 * (1. - 0.8 * ( irow - (nrow-1)/2 ) / nrow )) # rot 50% +-
-    elif rotationScheme is "Uniform":
-        rotConst.append( -3.5e-5 ) 
-    else:
-        rotConst.append( 0 )
+        # allocate the state and the work arrays once, they are reused every step
 
-    if windScheme is "Curled":
-        windU.append( 1e-8 * math.sin( (irow+0.5)/nrow * 2 * 3.14 ) ) 
-    elif windScheme is "Uniform":
-        windU.append( 1.e-8 )
-    else:
-        windU.append( 0 )
-itGlobal = 0
-
-U = numpy.zeros((nrow, ncol+1))
-V = numpy.zeros((nrow+1, ncol))
-H = numpy.zeros((nrow, ncol+1))
-Vmean = numpy.zeros((nrow+1, ncol))
-Umean = numpy.zeros((nrow, ncol+1))
-dUdT = numpy.zeros((nrow, ncol))
-dVdT = numpy.zeros((nrow, ncol))
-dHdT = numpy.zeros((nrow, ncol))
-dHdX = numpy.zeros((nrow, ncol+1))
-dHdY = numpy.zeros((nrow, ncol))
-dUdX = numpy.zeros((nrow, ncol))
-dVdY = numpy.zeros((nrow, ncol))
-rotV = numpy.zeros((nrow,ncol)) # interpolated to u locations
-rotU = numpy.zeros((nrow,ncol)) #              to v
-    
-midCell = int(ncol/2)
-if initialPerturbation is "Tower":
-    H[midCell,midCell] = 1
-elif initialPerturbation is "NSGradient":
-    H[0:midCell,:] = 0.1
-elif initialPerturbation is "EWGradient":
-    H[:,0:midCell] = 0.1
+        self.itGlobal = 0
 
-"""
-This is the work-horse subroutine.  It steps forward in time, taking ntAnim steps of
-duration dT.  
-"""
+        self.U = numpy.zeros((nrow, ncol+1))
+        self.V = numpy.zeros((nrow+1, ncol))
+        self.H = numpy.zeros((nrow, ncol+1))
+        self.Vmean = numpy.zeros((nrow+1, ncol))
+        self.Umean = numpy.zeros((nrow, ncol+1))
+        self.dUdT = numpy.zeros((nrow, ncol))
+        self.dVdT = numpy.zeros((nrow, ncol))
+        self.dHdT = numpy.zeros((nrow, ncol))
+        self.dHdX = numpy.zeros((nrow, ncol+1))
+        self.dHdY = numpy.zeros((nrow, ncol))
+        self.dUdX = numpy.zeros((nrow, ncol))
+        self.dVdY = numpy.zeros((nrow, ncol))
+        self.rotV = numpy.zeros((nrow,ncol)) # interpolated to u locations
+        self.rotU = numpy.zeros((nrow,ncol)) #              to v
 
-def animStep():    
+        midCell = int(ncol/2)
+        if initialPerturbation == "Tower":
+            self.H[midCell,midCell] = 1
+        elif initialPerturbation == "NSGradient":
+            self.H[0:midCell,:] = 0.1
+        elif initialPerturbation == "EWGradient":
+            self.H[:,0:midCell] = 0.1
 
-    global stepDump, itGlobal
+    def timeStepLoop(self):
+        '''Steps forward one time step, one grid cell at a time
 
-    # Time Loop
-    for it in range(0,ntAnim):
+        Slow reference implementation of timeStepVectorized.
+
+        '''
+
+        nrow, ncol, dX = self.nrow, self.ncol, self.dX
+        U, V, H = self.U, self.V, self.H
+        Umean, Vmean = self.Umean, self.Vmean
+        dHdX, dUdX, dHdY, dVdY = self.dHdX, self.dUdX, self.dHdY, self.dVdY
+        rotU, rotV = self.rotU, self.rotV
+        dUdT, dVdT, dHdT = self.dUdT, self.dVdT, self.dHdT
+        rotConst, windU = self.rotConst, self.windU
 
-        # Here is where you need to build some code
-        
         # Encode Longitudinal Derivatives Here
-        
+
         for irow in range(0, nrow):
-            
+
             for icol in range(0, ncol):
-                
+
                 dHdX[irow,icol] = (H[irow,icol]-H[irow,icol-1])/dX
-                dUdX[irow,icol] = (U[irow,icol+1]-U[irow,icol])/dX 
+                dUdX[irow,icol] = (U[irow,icol+1]-U[irow,icol])/dX
 
         # Encode Latitudinal Derivatives Here
-                
+
         for irow in range(0, nrow):
-            
+
             for icol in range(0, ncol):
-                
+
                 dHdY[irow,icol] = (H[irow,icol] - H[irow-1,icol])/dX
                 dVdY[irow,icol] = (V[irow+1,icol] - V[irow,icol])/dX
 
         # Calculate the Rotational Terms Here
-        
-       # print(U)
-        
-        if rotMethod == "simple":
-            
+
+        if self.rotMethod == "simple":
+
             for irow in range(0, nrow):
-            
+
                 for icol in range(0, ncol):
-                    
+
                     rotU[irow,icol] = rotConst[irow] * U[irow,icol]
                     rotV[irow,icol] = rotConst[irow] * V[irow,icol]
         else:
 
-            # interpolate the velocity to the H grid and calculate the rotational velocity         
+            # interpolate the velocity to the H grid and calculate the rotational velocity
             for irow in range(0, nrow):
-            
+
                 for icol in range(0, ncol):
-           
+
                     Umean[irow,icol] = (U[irow,icol] + U[irow,icol+1])/2 * rotConst[irow]
                     Vmean[irow,icol] = (V[irow,icol] + V[irow+1,icol])/2 * rotConst[irow]
-                    
-            # reinterpolate the velocity to the edge of the H grid 
-            
+
+            # reinterpolate the velocity to the edge of the H grid
+
             for irow in range(0, nrow):
-            
+
                 for icol in range(0, ncol):
-           
-                    rotU[irow,icol] = (Umean[irow,icol] + Umean[irow,icol-1])/2 
-                    rotV[irow,icol] = (Vmean[irow,icol] + Vmean[irow-1,icol])/2 
-       
+
+                    rotU[irow,icol] = (Umean[irow,icol] + Umean[irow,icol-1])/2
+                    rotV[irow,icol] = (Vmean[irow,icol] + Vmean[irow-1,icol])/2
+
         # Assemble the Time Derivatives Here
-           
+
         for irow in range(0, nrow):
-            
+
             for icol in range(0, ncol):
-                
-                dUdT[irow,icol] = rotV[irow,icol] - flowConst * dHdX[irow,icol] - dragConst * U[irow,icol] + windU[irow]
-                dVdT[irow,icol] = -rotU[irow,icol] - flowConst * dHdY[irow,icol] - dragConst * V[irow,icol]
-                dHdT[irow,icol] = -(dUdX[irow,icol] + dVdY[irow,icol]) * HBackground / dX
-                
+
+                dUdT[irow,icol] = rotV[irow,icol] - self.flowConst * dHdX[irow,icol] - self.dragConst * U[irow,icol] + windU[irow]
+                dVdT[irow,icol] = -rotU[irow,icol] - self.flowConst * dHdY[irow,icol] - self.dragConst * V[irow,icol]
+                dHdT[irow,icol] = -(dUdX[irow,icol] + dVdY[irow,icol]) * self.HBackground / dX
+
                 # Step Forward One Time Step (redoing a loop is useless here as there is no correlation between grid cases)
-                
-                U[irow,icol] = U[irow,icol] + dUdT[irow,icol]*dT
-                V[irow,icol] = V[irow,icol] + dVdT[irow,icol]*dT
-                H[irow,icol] = H[irow,icol] + dHdT[irow,icol]*dT
- 
-        # Update the Boundary and Ghost Cells
-        
-        if horizontalWrap == True:
-            U[:,ncol] = U[:,0]
-            H[:,ncol] = H[:,0]
+
+                U[irow,icol] = U[irow,icol] + dUdT[irow,icol]*self.dT
+                V[irow,icol] = V[irow,icol] + dVdT[irow,icol]*self.dT
+                H[irow,icol] = H[irow,icol] + dHdT[irow,icol]*self.dT
+
+    def timeStepVectorized(self):
+        '''Steps forward one time step with whole-array slices
+
+        Gives the same result as timeStepLoop. The rows and columns are the
+        last two axes, so the members of a ShallowWaterEnsemble on a leading
+        axis are stepped together.
+
+        '''
+
+        nrow, ncol, dX = self.nrow, self.ncol, self.dX
+        U, V, H = self.U, self.V, self.H
+
+        # Longitudinal Derivatives, the column -1 being the ghost column ncol
+
+        self.dHdX[...,1:ncol] = (H[...,1:ncol] - H[...,0:ncol-1])/dX
+        self.dHdX[...,0] = (H[...,0] - H[...,ncol])/dX
+        self.dUdX[...] = (U[...,1:ncol+1] - U[...,0:ncol])/dX
+
+        # Latitudinal Derivatives, the row -1 being the last row of H
+
+        self.dHdY[...,1:nrow,:] = (H[...,1:nrow,0:ncol] - H[...,0:nrow-1,0:ncol])/dX
+        self.dHdY[...,0,:] = (H[...,0,0:ncol] - H[...,nrow-1,0:ncol])/dX
+        self.dVdY[...] = (V[...,1:nrow+1,:] - V[...,0:nrow,:])/dX
+
+        # Rotational Terms
+
+        self.rotationTerms()
+
+        # Time Derivatives
+
+        self.dUdT[...] = self.rotV - self.flowConst * self.dHdX[...,0:ncol] - self.dragConst * U[...,0:ncol] + self.windU[...,numpy.newaxis]
+        self.dVdT[...] = -self.rotU - self.flowConst * self.dHdY - self.dragConst * V[...,0:nrow,:]
+        self.dHdT[...] = -(self.dUdX + self.dVdY) * self.HBackground / dX
+
+        # Step Forward One Time Step
+
+        U[...,0:ncol] += self.dUdT*self.dT
+        V[...,0:nrow,:] += self.dVdT*self.dT
+        H[...,0:ncol] += self.dHdT*self.dT
+
+    def rotationTerms(self):
+        '''Computes the rotational terms rotU and rotV of the current velocities
+
+        '''
+
+        nrow, ncol = self.nrow, self.ncol
+        U, V = self.U, self.V
+        Umean, Vmean = self.Umean, self.Vmean
+        rot = self.rotConst[...,numpy.newaxis]
+
+        if self.rotMethod == "simple":
+            self.rotU[...] = rot * U[...,0:ncol]
+            self.rotV[...] = rot * V[...,0:nrow,:]
         else:
-            U[:,ncol] = numpy.zeros(nrow)
-            U[:,0] = numpy.zeros(nrow)
-            
-        V[0,:] = numpy.zeros(ncol)
-        V[nrow,:] = numpy.zeros(ncol)
-        dHdY[0,:] = numpy.zeros(ncol)
-        
 
-#   Now you're done
+            # interpolate the velocity to the H grid and calculate the rotational velocity
 
-    itGlobal = itGlobal + ntAnim
+            Umean[...,0:ncol] = (U[...,0:ncol] + U[...,1:ncol+1])/2 * rot
+            Vmean[...,0:nrow,:] = (V[...,0:nrow,:] + V[...,1:nrow+1,:])/2 * rot
 
-def firstFrame():
-    global fig, ax, hPlot
-    fig, ax = plt.subplots()
-    ax.set_title("H")   
-    hh = H[:,0:ncol]
+            # reinterpolate the velocity to the edge of the H grid, the index -1
+            # pointing to the last column (row) of Umean (Vmean) as in the loop
+
+            self.rotU[...,1:ncol] = (Umean[...,1:ncol] + Umean[...,0:ncol-1])/2
+            self.rotU[...,0] = (Umean[...,0] + Umean[...,ncol])/2
+            self.rotV[...,1:nrow,:] = (Vmean[...,1:nrow,:] + Vmean[...,0:nrow-1,:])/2
+            self.rotV[...,0,:] = (Vmean[...,0,:] + Vmean[...,nrow,:])/2
+
+    def gradients(self, H):
+        '''Returns the gradients of H on the U and V edges of the cells
+
+        The gradient is 0 on the walls: the north and south edges, and the
+        east and west edges without horizontalWrap.
+
+        '''
+
+        nrow, ncol, dX = self.nrow, self.ncol, self.dX
+
+        gradX = (H - numpy.roll(H, 1, axis=-1))/dX
+        if self.horizontalWrap == False:
+            gradX[...,0] = 0
+        gradY = numpy.zeros(H.shape[:-2] + (nrow+1, ncol))
+        gradY[...,1:nrow,:] = (H[...,1:nrow,:] - H[...,0:nrow-1,:])/dX
+
+        return(gradX, gradY)
+
+    def divergence(self, U, V):
+        '''Returns the divergence of U and V on the nrow x ncol cells
+
+        '''
+
+        ncol, dX = self.ncol, self.dX
+
+        # velocity on the east edge of the cells, the last one being the periodic edge or a wall
+
+        Ueast = numpy.roll(U, -1, axis=-1)
+        if self.horizontalWrap == False:
+            Ueast[...,ncol-1] = 0
+
+        return((Ueast - U)/dX + (V[...,1:,:] - V[...,:-1,:])/dX)
+
+    def solveHelmholtz(self, rhs):
+        '''Solves (1 - c*Laplacian) H = rhs with c = (implicitWeight*dT)^2 * G * HBackground/dX
+
+        The grid is mirrored over its walls so that the zero gradient on the
+        walls becomes periodic, and the five points Laplacian is diagonal in
+        the Fourier space of the periodic grid.
+
+        '''
+
+        nrow, ncol = self.nrow, self.ncol
+        wrap = self.horizontalWrap == True
+
+        ext = numpy.concatenate((rhs, rhs[...,::-1,:]), axis=-2)
+        if not wrap:
+            ext = numpy.concatenate((ext, ext[...,::-1]), axis=-1)
+
+        if self.helmholtzDenom is None:
+            nY, nX = ext.shape[-2:]
+            sinY = numpy.sin(numpy.pi*numpy.arange(nY)/nY)**2
+            sinX = numpy.sin(numpy.pi*numpy.arange(nX//2+1)/nX)**2
+            c = (self.implicitWeight*self.dT)**2 * self.flowConst * self.HBackground/self.dX
+            self.helmholtzDenom = 1 + c*4/self.dX**2*(sinY[:,numpy.newaxis] + sinX[numpy.newaxis,:])
+
+        H = numpy.fft.irfft2(numpy.fft.rfft2(ext)/self.helmholtzDenom, s=ext.shape[-2:])
+
+        return(H[...,0:nrow,0:ncol])
+
+    def timeStepSemiImplicit(self):
+        '''Steps forward one time step, the gravity waves being implicit
+
+        The rotation, drag and wind terms are explicit as in timeStepVectorized.
+        The pressure gradient and the divergence are weighted between the old
+        and the new time step by implicitWeight, which gives a Helmholtz
+        equation for the new H solved by solveHelmholtz. The velocities are
+        then updated with the gradient of the new H. On the periodic edge the
+        gradient uses the last column of H rather than the ghost column.
+
+        '''
+
+        nrow, ncol, dT = self.nrow, self.ncol, self.dT
+        theta = self.implicitWeight
+        U, V, H = self.U, self.V, self.H
+        D = self.HBackground/self.dX
+
+        Hold = H[...,0:ncol].copy()
+        Uold = U[...,0:ncol].copy()
+        Vold = V.copy()
+        gradX, gradY = self.gradients(Hold)
+
+        # explicit part of the velocities
+
+        self.rotationTerms()
+        Ustar = Uold + (self.rotV - self.dragConst * Uold + self.windU[...,numpy.newaxis] - (1-theta)*self.flowConst*gradX)*dT
+        Vstar = Vold.copy()
+        Vstar[...,0:nrow,:] += (-self.rotU - self.dragConst * Vold[...,0:nrow,:] - (1-theta)*self.flowConst*gradY[...,0:nrow,:])*dT
+        Vstar[...,0,:] = 0
+        Vstar[...,nrow,:] = 0
+        if self.horizontalWrap == False:
+            Ustar[...,0] = 0
+
+        # implicit elevation, then the velocities with its gradient
+
+        rhs = Hold - dT*D*(theta*self.divergence(Ustar, Vstar) + (1-theta)*self.divergence(Uold, Vold))
+        Hnew = self.solveHelmholtz(rhs)
+        gradX, gradY = self.gradients(Hnew)
+
+        U[...,0:ncol] = Ustar - theta*dT*self.flowConst*gradX
+        V[...] = Vstar - theta*dT*self.flowConst*gradY
+        H[...,0:ncol] = Hnew
+
+    def updateBoundaries(self):
+        '''Updates the boundary and ghost cells
+
+        '''
+
+        nrow, ncol = self.nrow, self.ncol
+
+        if self.horizontalWrap == True:
+            self.U[...,ncol] = self.U[...,0]
+            self.H[...,ncol] = self.H[...,0]
+        else:
+            self.U[...,ncol] = 0
+            self.U[...,0] = 0
+
+        self.V[...,0,:] = 0
+        self.V[...,nrow,:] = 0
+        self.dHdY[...,0,:] = 0
+
+    def step(self, n: int = None):
+        '''Steps the model forward in time
+
+
+        Parameters
+        ----------
+        n : int
+            Number of time steps of duration dT to take. Default to ntAnim.
+
+        Returns
+        -------
+        The model itself.
+
+        '''
+
+        if n is None:
+            n = self.ntAnim
+
+        if self.aborted:
+            return(self)
+
+        if self.diagnostics is None:
+            self.advance(n)
+            return(self)
+
+        # step up to each time step of the diagnostics
+
+        every = self.diagnostics.every
+        while n > 0:
+            nChunk = min(n, every - self.itGlobal % every)
+            self.advance(nChunk)
+            n = n - nChunk
+            if self.itGlobal % every == 0 and self.diagnostics.record(self):
+                print("Run aborted at time step", self.itGlobal, ":", self.diagnostics.reason)
+                self.aborted = True
+                self.close()
+                break
+
+        return(self)
+
+    def advance(self, n: int):
+        '''Takes n time steps without diagnostics
+
+        '''
+
+        if self.nProcesses is not None and self.nProcesses > 1 and self.stepMethod == "vectorized":
+            self.stepParallel(n)
+            self.itGlobal = self.itGlobal + n
+            return
+
+        # Time Loop
+
+        for it in range(0,n):
+
+            if self.stepMethod == "loop":
+                self.timeStepLoop()
+            elif self.stepMethod == "semiImplicit":
+                self.timeStepSemiImplicit()
+            else:
+                self.timeStepVectorized()
+            self.updateBoundaries()
+
+        self.itGlobal = self.itGlobal + n
+
+    def startWorkers(self):
+        '''Moves U, V and H to shared memory and starts the worker processes
+
+        Each worker owns a strip of rows and reads the rows next to its strip
+        from the shared arrays, between two barriers of the time step.
+
+        '''
+
+        nProcesses = min(self.nProcesses, self.nrow)
+        ctx = multiprocessing.get_context()
+
+        # copy the state into shared memory buffers, the model arrays becoming views on them
+
+        self.sharedBuffers = []
+        names = {}
+        for name in ("U", "V", "H"):
+            array = getattr(self, name)
+            shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            shared = numpy.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared[...] = array
+            setattr(self, name, shared)
+            self.sharedBuffers.append(shm)
+            names[name] = (shm.name, array.shape)
+
+        params = {"nrow": self.nrow, "ncol": self.ncol, "dX": self.dX, "dT": self.dT,
+                  "flowConst": self.flowConst, "dragConst": self.dragConst,
+                  "HBackground": self.HBackground, "rotConst": self.rotConst,
+                  "windU": self.windU, "rotMethod": self.rotMethod,
+                  "horizontalWrap": self.horizontalWrap}
+
+        barrier = ctx.Barrier(nProcesses)
+        self.done = ctx.Queue()
+        self.workers = []
+        bounds = numpy.linspace(0, self.nrow, nProcesses+1).astype(int)
+        for r0, r1 in zip(bounds[:-1], bounds[1:]):
+            commands = ctx.Queue()
+            worker = ctx.Process(target=stripWorker,
+                                 args=(names, params, r0, r1, barrier, commands, self.done),
+                                 daemon=True)
+            worker.start()
+            self.workers.append((worker, commands))
+
+        # release the workers and the buffers even if close() is never called
+
+        self.finalizer = weakref.finalize(self, stopWorkers, self.workers, self.sharedBuffers)
+
+    def stepParallel(self, n: int):
+        '''Steps the model forward n time steps with the worker processes
+
+        Gives the same result as n steps of timeStepVectorized.
+
+        '''
+
+        if self.workers is None:
+            self.startWorkers()
+
+        for worker, commands in self.workers:
+            commands.put(n)
+        errors = [self.done.get() for worker in self.workers]
+        errors = [e for e in errors if e is not None]
+        if len(errors) > 0:
+            self.close()
+            raise RuntimeError("A worker process failed: " + errors[0])
+
+    def close(self):
+        '''Stops the worker processes and moves U, V and H back to the process memory
+
+        '''
+
+        if self.workers is None:
+            return
+
+        self.U = self.U.copy()
+        self.V = self.V.copy()
+        self.H = self.H.copy()
+        self.workers = None
+        self.sharedBuffers = []
+        self.finalizer()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return(False)
+
+    def run(self, nSlices: int, callback = None, checkpointPath: str = None,
+            checkpointEvery: int = 1, historyPath: str = None):
+        '''Runs the model over several slices of ntAnim time steps
+
+
+        Parameters
+        ----------
+        nSlices : int
+            Number of slices to run.
+        callback : function
+            Optional function called with the model after each slice, for
+            instance to plot or print it.
+        checkpointPath : str
+            Optional checkpoint file written by saveCheckpoint. It may hold a
+            format for itGlobal, e.g. "run_%09d.npz", to keep every checkpoint.
+        checkpointEvery : int
+            Number of slices between two checkpoints.
+        historyPath : str
+            Optional history file where the state of each slice is appended
+            by appendHistory, starting with the current state for a new file.
+
+        Returns
+        -------
+        The model itself.
+
+        '''
+
+        if historyPath is not None and (not os.path.exists(historyPath) or os.path.getsize(historyPath) == 0):
+            self.appendHistory(historyPath)
+
+        try:
+            for iSlice in range(0,nSlices):
+                if self.aborted:
+                    break
+                self.step()
+                if historyPath is not None:
+                    self.appendHistory(historyPath)
+                if checkpointPath is not None and (iSlice+1) % checkpointEvery == 0:
+                    self.saveCheckpoint(checkpointPath)
+                if callback is not None:
+                    callback(self)
+        except BaseException:
+            self.close()
+            raise
+
+        return(self)
+
+    def config(self):
+        '''Returns the parameters of the model as a dictionary
+
+        '''
+
+        return({"ncol": self.ncol, "nrow": self.nrow, "dT": self.dT, "G": self.G,
+                "rotMethod": self.rotMethod, "rotationScheme": self.rotationScheme,
+                "windScheme": self.windScheme, "initialPerturbation": self.initialPerturbation,
+                "horizontalWrap": self.horizontalWrap, "ntAnim": self.ntAnim,
+                "stepMethod": self.stepMethod, "HBackground": self.HBackground, "dX": self.dX,
+                "dragConst": self.dragConst, "meanLatitude": self.meanLatitude,
+                "implicitWeight": self.implicitWeight})
+
+    def saveCheckpoint(self, path: str):
+        '''Saves U, V, H, itGlobal and the parameters of the model to a npz file
+
+
+        Parameters
+        ----------
+        path : str
+            File name. If it holds a format, e.g. "run_%09d.npz", it is
+            formatted with itGlobal.
+
+        Returns
+        -------
+        The file name.
+
+        '''
+
+        if "%" in path:
+            path = path % self.itGlobal
+        with open(path, "wb") as f:
+            numpy.savez_compressed(f, U=self.U, V=self.V, H=self.H, itGlobal=self.itGlobal,
+                                   config=json.dumps(self.config()))
+        return(path)
+
+    def loadCheckpoint(self, path: str):
+        '''Restores U, V, H and itGlobal from a checkpoint of a model of the same grid
+
+        '''
+
+        with numpy.load(path) as data:
+            if data["H"].shape != self.H.shape or data["V"].shape != self.V.shape:
+                raise ValueError("The checkpoint grid " + str(data["H"].shape) +
+                                 " does not match the model grid " + str(self.H.shape))
+            self.U[...] = data["U"]
+            self.V[...] = data["V"]
+            self.H[...] = data["H"]
+            self.itGlobal = int(data["itGlobal"])
+
+        return(self)
+
+    @classmethod
+    def fromCheckpoint(cls, path: str, **kwargs):
+        '''Returns a model with the parameters and the state of a checkpoint
+
+        The keyword arguments override the saved parameters, e.g. ntAnim or
+        nProcesses.
+
+        '''
+
+        with numpy.load(path) as data:
+            config = json.loads(str(data["config"]))
+        config.update(kwargs)
+        return(cls(**config).loadCheckpoint(path))
+
+    def appendHistory(self, path: str):
+        '''Appends itGlobal, the time in days, H, U and V to a history file
+
+        The file starts with a header giving the grid, then holds one fixed
+        size record per call, so it can grow without being read and is opened
+        as a memory map by readHistory.
+
+        '''
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(historyHeader(self.nrow, self.ncol))
+        else:
+            with open(path, "rb") as f:
+                header = f.read(len(historyHeader(self.nrow, self.ncol)))
+            if header != historyHeader(self.nrow, self.ncol):
+                raise ValueError(path + " is not a history file of a " + str(self.nrow) + " x " + str(self.ncol) + " grid")
+
+        record = numpy.zeros(1, dtype=historyDtype(self.nrow, self.ncol))
+        record["itGlobal"] = self.itGlobal
+        record["days"] = self.days()
+        record["H"] = self.H
+        record["U"] = self.U
+        record["V"] = self.V
+        with open(path, "ab") as f:
+            record.tofile(f)
+
+    def days(self):
+        '''Returns the model time in days
+
+        '''
+
+        return(self.itGlobal * self.dT / 86400.)
+
+# parameters of ShallowWaterModel that can differ between the members of a ShallowWaterEnsemble
+
+memberParameters = ("rotationScheme", "windScheme", "initialPerturbation", "dragConst", "meanLatitude")
+
+class ShallowWaterEnsemble(ShallowWaterModel):
+    '''Batch of ShallowWaterModel runs on the same grid, stepped together
+
+    U, V, H and the work arrays get a leading members axis, as well as
+    rotConst, windU and dragConst, and the "vectorized" and "semiImplicit"
+    kernels broadcast over it, so a time step of the whole ensemble is one
+    pass of whole-array operations. The loop method, nProcesses and the
+    history file are for single models and raise a ValueError.
+
+
+    Parameters
+    ----------
+    members : list
+        One dictionary per member with its own rotationScheme, windScheme,
+        initialPerturbation, dragConst or meanLatitude, e.g.
+        [{"rotationScheme": "Uniform"}, {"dragConst": 2.E-6}]. Any other
+        key raises a ValueError as the kernels use the shared parameters.
+    kwargs :
+        Parameters of ShallowWaterModel shared by all the members.
+
+    '''
+
+    def __init__(self, members: list, **kwargs):
+
+        for i, member in enumerate(members):
+            unknown = [key for key in member if key not in memberParameters]
+            if unknown:
+                raise ValueError("Member " + str(i) + " sets " + ", ".join(unknown) +
+                                 ", the members can only set " + ", ".join(memberParameters))
+        if kwargs.get("stepMethod", "vectorized") not in ("vectorized", "semiImplicit"):
+            raise ValueError("An ensemble steps with \"vectorized\" or \"semiImplicit\", not " + repr(kwargs["stepMethod"]))
+        if kwargs.get("nProcesses") is not None:
+            raise ValueError("An ensemble steps in this process, nProcesses is for single models")
+
+        super().__init__(**kwargs)
+        self.members = members
+        self.sharedConfig = super().config()
+
+        # build each member alone, then stack their constants and arrays
+
+        models = [ShallowWaterModel(**dict(kwargs, **member)) for member in members]
+        self.latitude = [model.latitude for model in models]
+        self.rotConst = numpy.array([model.rotConst for model in models])
+        self.windU = numpy.array([model.windU for model in models])
+        self.dragConst = numpy.array([model.dragConst for model in models], dtype=float)[:,numpy.newaxis,numpy.newaxis]
+
+        for name in ("U", "V", "H", "Umean", "Vmean", "dUdT", "dVdT", "dHdT",
+                     "dHdX", "dHdY", "dUdX", "dVdY", "rotU", "rotV"):
+            setattr(self, name, numpy.array([getattr(model, name) for model in models]))
+
+    def config(self):
+        '''Returns the shared parameters and the members as a dictionary
+
+        '''
+
+        return(dict(self.sharedConfig, members=self.members))
+
+    def appendHistory(self, path: str):
+        '''History files hold a single model, raises a ValueError before opening the file
+
+        '''
+
+        raise ValueError("The history file is for single models, use member(i).appendHistory")
+
+    def member(self, i: int):
+        '''Returns a ShallowWaterModel with the parameters and a copy of the state of the member i
+
+        '''
+
+        model = ShallowWaterModel(**dict(self.sharedConfig, **self.members[i]))
+        model.U[...] = self.U[i]
+        model.V[...] = self.V[i]
+        model.H[...] = self.H[i]
+        model.itGlobal = self.itGlobal
+        return(model)
+
+class ShallowWaterDiagnostics:
+    '''Conservation and energy diagnostics of a ShallowWaterModel
+
+    Every "every" time steps the model calls record, which computes with
+    whole-array reductions over the nrow x ncol cells the total mass (sum of
+    H), the kinetic and potential energies per unit density, the largest |U|
+    and |V| and the CFL number. For a ShallowWaterEnsemble they are summed
+    (or maximized) over the members. The energies use the depth HBackground/dX of
+    the continuity equation of the model, so their sum is the energy kept by
+    the gravity waves. The CFL number adds the gravity wave speed to the
+    largest velocity, except for "semiImplicit" where the waves are implicit.
+    The records are kept in a ring buffer and optionally appended to a CSV
+    file.
+
+
+    Parameters
+    ----------
+    every : int
+        Number of time steps between two records.
+    bufferSize : int
+        Number of records kept in memory, the oldest ones being overwritten.
+    csvPath : str
+        Optional CSV file where every record is appended.
+    abortOnNaN : boolean
+        Should the run stop when a field is not finite ?
+    maxCFL : float
+        Optional CFL number above which the run stops.
+
+    '''
+
+    fields = ("itGlobal", "days", "mass", "kinetic", "potential", "maxU", "maxV", "CFL")
+
+    def __init__(self,
+                 every: int = 100,
+                 bufferSize: int = 1000,
+                 csvPath: str = None,
+                 abortOnNaN: bool = True,
+                 maxCFL: float = None):
+
+        self.every = every
+        self.csvPath = csvPath
+        self.abortOnNaN = abortOnNaN
+        self.maxCFL = maxCFL
+        self.buffer = numpy.zeros(bufferSize, dtype=[(name, float) for name in self.fields])
+        self.nRecords = 0
+        self.reason = None
+
+        if csvPath is not None and (not os.path.exists(csvPath) or os.path.getsize(csvPath) == 0):
+            with open(csvPath, "w") as f:
+                f.write(",".join(self.fields) + "\n")
+
+    def record(self, model):
+        '''Records the diagnostics of the model state
+
+        Returns
+        -------
+        True if the run should be aborted, the reason being in self.reason.
+
+        '''
+
+        ncol, nrow = model.ncol, model.nrow
+        H = model.H[...,0:ncol]
+        U = model.U[...,0:ncol]
+        V = model.V
+        depth = model.HBackground/model.dX
+        area = model.dX**2
+
+        maxU = numpy.max(numpy.abs(U))
+        maxV = numpy.max(numpy.abs(V))
+        speed = max(maxU, maxV)
+        if model.stepMethod != "semiImplicit":
+            speed = speed + math.sqrt(model.flowConst*depth)
+
+        values = (model.itGlobal,
+                  model.days(),
+                  numpy.sum(H),
+                  0.5*depth*(numpy.sum(U*U) + numpy.sum(V*V))*area,
+                  0.5*model.flowConst*numpy.sum(H*H)*area,
+                  maxU,
+                  maxV,
+                  speed*model.dT/model.dX)
+
+        self.buffer[self.nRecords % len(self.buffer)] = values
+        self.nRecords = self.nRecords + 1
+        if self.csvPath is not None:
+            with open(self.csvPath, "a") as f:
+                f.write(",".join(repr(float(v)) for v in values) + "\n")
+
+        # check the state
+
+        if self.abortOnNaN and not numpy.all(numpy.isfinite(values)):
+            self.reason = "not finite values"
+            return(True)
+        if self.maxCFL is not None and values[-1] > self.maxCFL:
+            self.reason = "CFL number " + str(values[-1]) + " above " + str(self.maxCFL)
+            return(True)
+        return(False)
+
+    def records(self):
+        '''Returns the records of the ring buffer, from the oldest to the newest
+
+        '''
+
+        n = len(self.buffer)
+        if self.nRecords <= n:
+            return(self.buffer[0:self.nRecords].copy())
+        i = self.nRecords % n
+        return(numpy.concatenate((self.buffer[i:], self.buffer[:i])))
+
+def historyDtype(nrow, ncol):
+    '''Returns the record type of a history file of a nrow x ncol grid
+
+    '''
+    return(numpy.dtype([("itGlobal", "<i8"), ("days", "<f8"), ("H", "<f8", (nrow, ncol+1)),
+                        ("U", "<f8", (nrow, ncol+1)), ("V", "<f8", (nrow+1, ncol))]))
+
+def historyHeader(nrow, ncol):
+    '''Returns the 64 bytes header of a history file of a nrow x ncol grid
+
+    '''
+    return(b"SWHISTORY1" + numpy.array([nrow, ncol], dtype="<i8").tobytes() + bytes(38))
+
+def readHistory(path):
+    '''Returns the records of a history file as a read-only memory map
+
+    The fields are itGlobal, days, H, U and V, so readHistory(path)["H"][k]
+    is H after the k-th record, read from the disk when accessed.
+
+    '''
+    with open(path, "rb") as f:
+        header = f.read(64)
+    if header[0:10] != b"SWHISTORY1":
+        raise ValueError(path + " is not a history file")
+    nrow, ncol = numpy.frombuffer(header[10:26], dtype="<i8")
+    dtype = historyDtype(int(nrow), int(ncol))
+    nRecords = (os.path.getsize(path) - 64) // dtype.itemsize
+    return(numpy.memmap(path, dtype=dtype, mode="r", offset=64, shape=(nRecords,)))
+
+def stripTendencies(params, U, V, H, r0, r1):
+    '''Returns the time derivatives of U, V and H on the rows r0 to r1-1
+
+    Same operations as timeStepVectorized on a strip of rows, reading the
+    row r0-1 of H and V and the row r1 of V next to the strip. The row -1 of
+    H is its last row, and the rotation term of the row 0 uses a zero row as
+    Vmean[nrow] in timeStepVectorized.
+
+    '''
+
+    ncol, dX = params["ncol"], params["dX"]
+    rotConst = params["rotConst"]
+    rot = rotConst[r0:r1,numpy.newaxis]
+    Us = U[r0:r1,:]
+    Hs = H[r0:r1,:]
+
+    # Longitudinal Derivatives, the column -1 being the ghost column ncol
+
+    dHdX = numpy.zeros((r1-r0, ncol))
+    dHdX[:,1:ncol] = (Hs[:,1:ncol] - Hs[:,0:ncol-1])/dX
+    dHdX[:,0] = (Hs[:,0] - Hs[:,ncol])/dX
+    dUdX = (Us[:,1:ncol+1] - Us[:,0:ncol])/dX
+
+    # Latitudinal Derivatives, with the row above the strip
+
+    dHdY = numpy.zeros((r1-r0, ncol))
+    dHdY[1:,:] = (Hs[1:,0:ncol] - Hs[:-1,0:ncol])/dX
+    dHdY[0,:] = (Hs[0,0:ncol] - H[r0-1,0:ncol])/dX
+    dVdY = (V[r0+1:r1+1,:] - V[r0:r1,:])/dX
+
+    # Rotational Terms
+
+    if params["rotMethod"] == "simple":
+        rotU = rot * Us[:,0:ncol]
+        rotV = rot * V[r0:r1,:]
+    else:
+        Umean = numpy.zeros((r1-r0, ncol+1))
+        Umean[:,0:ncol] = (Us[:,0:ncol] + Us[:,1:ncol+1])/2 * rot
+        Vmean = (V[r0:r1,:] + V[r0+1:r1+1,:])/2 * rot
+        if r0 == 0:
+            VmeanAbove = numpy.zeros(ncol)
+        else:
+            VmeanAbove = (V[r0-1,:] + V[r0,:])/2 * rotConst[r0-1]
+
+        rotU = numpy.zeros((r1-r0, ncol))
+        rotU[:,1:ncol] = (Umean[:,1:ncol] + Umean[:,0:ncol-1])/2
+        rotU[:,0] = (Umean[:,0] + Umean[:,ncol])/2
+        rotV = numpy.zeros((r1-r0, ncol))
+        rotV[1:,:] = (Vmean[1:,:] + Vmean[:-1,:])/2
+        rotV[0,:] = (Vmean[0,:] + VmeanAbove)/2
+
+    # Time Derivatives
+
+    dUdT = rotV - params["flowConst"] * dHdX - params["dragConst"] * Us[:,0:ncol] + params["windU"][r0:r1,numpy.newaxis]
+    dVdT = -rotU - params["flowConst"] * dHdY - params["dragConst"] * V[r0:r1,:]
+    dHdT = -(dUdX + dVdY) * params["HBackground"] / dX
+
+    return(dUdT, dVdT, dHdT)
+
+def stopWorkers(workers, sharedBuffers):
+    '''Stops the worker processes and unlinks the shared memory buffers of a model
+
+    Run once by close() or by the finalizer of a model collected without
+    being closed, whose arrays may still view the buffers.
+
+    '''
+
+    for worker, commands in workers:
+        commands.put(None)
+    for worker, commands in workers:
+        worker.join()
+    for shm in sharedBuffers:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        shm.unlink()
+
+def stripWorker(names, params, r0, r1, barrier, commands, done):
+    '''Steps the rows r0 to r1-1 of the shared U, V and H, run by the worker processes
+
+    For each number of steps read from commands, every step computes the
+    time derivatives of the strip from the current state, waits for all the
+    strips, updates the strip and its boundaries, and waits again. Puts None
+    in done once the steps are finished, or the error message.
+
+    '''
+
+    buffers = [shared_memory.SharedMemory(name=names[name][0]) for name in ("U", "V", "H")]
+    U, V, H = [numpy.ndarray(names[name][1], dtype=float, buffer=shm.buf)
+               for name, shm in zip(("U", "V", "H"), buffers)]
+    nrow, ncol, dT = params["nrow"], params["ncol"], params["dT"]
+
+    while True:
+        n = commands.get()
+        if n is None:
+            break
+        try:
+            for it in range(0,n):
+                dUdT, dVdT, dHdT = stripTendencies(params, U, V, H, r0, r1)
+                barrier.wait()
+
+                U[r0:r1,0:ncol] += dUdT*dT
+                V[r0:r1,:] += dVdT*dT
+                H[r0:r1,0:ncol] += dHdT*dT
+
+                # boundaries of the strip, as updateBoundaries
+
+                if params["horizontalWrap"] == True:
+                    U[r0:r1,ncol] = U[r0:r1,0]
+                    H[r0:r1,ncol] = H[r0:r1,0]
+                else:
+                    U[r0:r1,ncol] = 0
+                    U[r0:r1,0] = 0
+                if r0 == 0:
+                    V[0,:] = 0
+                if r1 == nrow:
+                    V[nrow,:] = 0
+
+                barrier.wait()
+            done.put(None)
+        except Exception as error:
+            barrier.abort()
+            done.put(repr(error))
+
+    for shm in buffers:
+        shm.close()
+
+def plotFields(ax, H, U, V, arrowScale = 30, animated = False):
+    '''Creates the H image and the quivers of the U velocities on the west edges and of the 
+    V velocities on the north edges of the nrow x ncol cells
+
+    '''
+    nrow, ncol = H.shape
+    ax.set_title("H")
     loc = tkr.IndexLocator(base=1, offset=1)
     ax.xaxis.set_major_locator(loc)
     ax.yaxis.set_major_locator(loc)
     grid = ax.grid(which='major', axis='both', linestyle='-')
-    hPlot = ax.imshow(hh, interpolation='nearest', clim=(-0.5,0.5))   
-    plotArrows()
-    plt.show(block=False) 
-
-def plotArrows():
-    global quiv, quiv2
-    xx = []
-    yy = []
-    uu = []
-    vv = []
-    for irow in range( 0, nrow ):
-        for icol in range( 0, ncol ):
-            xx.append(icol - 0.5)
-            yy.append(irow )
-            uu.append( U[irow,icol] * arrowScale )
-            vv.append( 0 )
-    quiv = ax.quiver( xx, yy, uu, vv, color='white', scale=1)
-    for irow in range( 0, nrow ):
-        for icol in range( 0, ncol ):
-            xx.append(icol)
-            yy.append(irow - 0.5)
-            uu.append( 0 )
-            vv.append( -V[irow,icol] * arrowScale )
-    quiv2 = ax.quiver( xx, yy, uu, vv, color='white', scale=1)
-
-def updateFrame():
-    global fig, ax, hPlot, quiv, quiv2
-    hh = H[:,0:ncol]
-    hPlot.set_array(hh)
-    quiv.remove()    
-    quiv2.remove()
-    plotArrows()
-    plt.pause(0.00001)
-    fig.canvas.draw()
-    print("Time: ", math.floor( itGlobal * dT / 86400.*10)/10, "days")
-
-def textDump():
-    print("time step ", itGlobal)    
-    print("H", H)
+    hPlot = ax.imshow(H, interpolation='nearest', clim=(-0.5,0.5), animated=animated)
+    xx, yy = numpy.meshgrid(numpy.arange(ncol), numpy.arange(nrow))
+    zero = numpy.zeros((nrow, ncol))
+    quiv = ax.quiver( xx - 0.5, yy, U * arrowScale, zero, color='white', scale=1, animated=animated)
+    quiv2 = ax.quiver( xx, yy - 0.5, zero, -V * arrowScale, color='white', scale=1, animated=animated)
+    return(hPlot, quiv, quiv2)
+
+def firstFrame(model, arrowScale = 30, blit = True):
+    '''Plots the first frame of a model and returns its artists
+    
+    The H image and the velocity arrows are created once here and then only their data is 
+    updated by updateFrame. With blit, only these artists are redrawn over a saved background.
+
+    '''
+    fig, ax = plt.subplots()
+    hPlot, quiv, quiv2 = plotFields(ax, *sliceFields(model), arrowScale, animated=blit)
+    frame = {"fig": fig, "ax": ax, "hPlot": hPlot, "quiv": quiv, "quiv2": quiv2,
+             "arrowScale": arrowScale, "blit": blit, "background": None}
+    plt.show(block=False)
+    if blit:
+        
+        # save the background without the animated artists, again each time the figure is fully drawn 
+        
+        def saveBackground(event):
+            frame["background"] = fig.canvas.copy_from_bbox(ax.bbox)
+            drawArtists(frame)
+        
+        fig.canvas.mpl_connect("draw_event", saveBackground)
+        fig.canvas.draw()
+    return(frame)
+
+def sliceFields(model):
+    '''Returns copies of H, U and V on the nrow x ncol cells, without the ghost cells
+
+    '''
+    return(model.H[:,0:model.ncol].copy(), model.U[:,0:model.ncol].copy(), model.V[0:model.nrow,:].copy())
+
+def setFrameData(model, frame):
+    '''Updates the data of the frame artists in place with the model state
+
+    '''
+    arrowScale = frame["arrowScale"]
+    H, U, V = sliceFields(model)
+    frame["hPlot"].set_array(H)
+    frame["quiv"].set_UVC(U * arrowScale, 0)
+    frame["quiv2"].set_UVC(0, -V * arrowScale)
+
+def drawArtists(frame):
+    ax = frame["ax"]
+    ax.draw_artist(frame["hPlot"])
+    ax.draw_artist(frame["quiv"])
+    ax.draw_artist(frame["quiv2"])
+
+def updateFrame(model, frame):
+    setFrameData(model, frame)
+    fig = frame["fig"]
+    if frame["blit"] and frame["background"] is not None:
+        fig.canvas.restore_region(frame["background"])
+        drawArtists(frame)
+        fig.canvas.blit(frame["ax"].bbox)
+        fig.canvas.flush_events()
+    else:
+        plt.pause(0.00001)
+        fig.canvas.draw()
+    print("Time: ", math.floor( model.days()*10)/10, "days")
+
+def drawFrame(fig, frame, arrowScale = 30):
+    '''Draws a (days, H, U, V) frame on an empty figure, as done by firstFrame
+
+    '''
+    days, H, U, V = frame
+    ax = fig.add_subplot()
+    plotFields(ax, H, U, V, arrowScale)
+    ax.set_xlabel("Time: " + str(math.floor( days*10)/10) + " days")
+
+def sliceFrames(model, nSlices):
+    '''Yields the (days, H, U, V) frames of the initial state and of the next nSlices slices
+
+    '''
+    yield((model.days(),) + sliceFields(model))
+    for iSlice in range(0,nSlices):
+        model.step()
+        yield((model.days(),) + sliceFields(model))
+
+def exportRun(model, nSlices, outputPath, arrowScale = 30, nProcesses = None, fps = 25):
+    '''Runs the model over nSlices slices and renders the frames offline over a process pool
+    
+    The frames are drawn without display, so this also works on headless servers and in IDEs 
+    where the animation does not. The model runs in this process while the previous frames 
+    are rendered by the workers.
+
+    Parameters
+    ----------
+    model : ShallowWaterModel
+        Model to run.
+    nSlices : int
+        Number of slices of ntAnim time steps to run.
+    outputPath : str
+        Either a ".gif" or ".mp4" file, or a directory for a PNG sequence.
+    arrowScale : float
+        Scale of the velocity arrows.
+    nProcesses : int
+        Number of worker processes. Default to the number of CPUs.
+    fps : int
+        Frames per second of the GIF or MP4 file.
+
+    Returns
+    -------
+    Number of frames rendered.
+
+    '''
+    return(AnimationExport.ExportFrames(functools.partial(drawFrame, arrowScale = arrowScale),
+                                        sliceFrames(model, nSlices), outputPath,
+                                        nProcesses = nProcesses, fps = fps))
+
+def textDump(model):
+    print("time step ", model.itGlobal)
+    print("H", model.H)
     print("dHdX" )
-    print( dHdX)
+    print( model.dHdX)
     print("dHdY" )
-    print( dHdY)
+    print( model.dHdY)
     print("U" )
-    print( U)
+    print( model.U)
     print("dUdX" )
-    print( dUdX)
+    print( model.dUdX)
     print("rotV" )
-    print( rotV)
+    print( model.rotV)
     print("V" )
-    print( V)
+    print( model.V)
     print("dVdY" )
-    print( dVdY)
+    print( model.dVdY)
     print("rotU" )
-    print( rotU)
+    print( model.rotU)
     print("dHdT" )
-    print( dHdT)
+    print( model.dHdT)
     print("dUdT" )
-    print( dUdT)
+    print( model.dUdT)
     print("dVdT" )
-    print( dVdT)
-
-if textOutput is True:
-    textDump()
-if plotOutput is True:
-    firstFrame()
-for i_anim_step in range(0,nSlices):
-    animStep()
+    print( model.dVdT)
+
+if __name__ == "__main__":
+
+    # Grid and Variable Initialization -- stuff you might play around with
+
+    ncol = 10
+    nSlices = 400
+    ntAnim = 1000
+    horizontalWrap = True
+    rotationScheme = "PlusMinus"
+    windScheme = "curled"
+    initialPerturbation = ""
+    plotOutput = True
+    arrowScale = 30
+    textOutput = False
+    stepMethod = "vectorized" # "vectorized", "loop" (slow reference implementation) or "semiImplicit"
+    rotMethod = "simple"
+
+    dT = 600    # seconds
+    G = 9.8e-4  # artificially low to allow a long time step, 9.8 with "semiImplicit"
+
+    model = ShallowWaterModel(ncol=ncol,
+                              dT=dT,
+                              G=G,
+                              rotMethod=rotMethod,
+                              rotationScheme=rotationScheme,
+                              windScheme=windScheme,
+                              initialPerturbation=initialPerturbation,
+                              horizontalWrap=horizontalWrap,
+                              ntAnim=ntAnim,
+                              stepMethod=stepMethod)
+
+    # define what is done after each slice
+
+    def showSlice(model):
+        if textOutput is True:
+            textDump(model)
+        if plotOutput is True:
+            updateFrame(model, frame)
+
     if textOutput is True:
-        textDump()
+        textDump(model)
     if plotOutput is True:
-        updateFrame()
-#print(dHdT[0,1])
-
+        frame = firstFrame(model, arrowScale)
+    model.run(nSlices, callback=showSlice)
@@ -37,7 +37,8 @@ def TemperatureAlbedosDF(LRange,
                          albedoIni: float, 
                          epsilon: float,
                          MeanTempVal,
-                         nIters: int):
+                         nIters: int,
+                         tolerance: float = None):
     '''Returns a data frame of the solar Energy, temperature and albedo
     
 
@@ -55,10 +56,14 @@ def TemperatureAlbedosDF(LRange,
         numpy array with three colums : mean temp, ice altitutde and albedo.
     nIters : int
         number of iterations for the inner loop
+    tolerance : float
+        If given, the iterations for one L stop as soon as the temperature changes by less than 
+        tolerance in K, so there can be less than nIters iterations per L.
 
     Returns
     -------
-    Numpy array with time, temperature and IR heat form the planet.
+    Numpy array with L, iteration number, temperature, albedo, ice latitude and hysteresis way 
+    (-1 descending, 1 ascending). The iterations of each L are followed by a row of NaN.
 
     '''
     
@@ -74,137 +79,267 @@ def TemperatureAlbedosDF(LRange,
     
     mIce, bIce, mAlbedo, bAlbedo = FitParam(MeanTempVal)
     
-    # intitiate the different columns of the data frame 
+    # get the L values of the descending and ascending ways 
     
-    LArr = [LRange[1],] # Array containing L value
-    nIter = [0,] # array containing nIter Value
-    albedo = [albedoIni,] # Array containing Albedo
-    Temp = [(LArr[0]*(1-albedo[0])/(4*sigma*epsilon))**(1/4),] #Array containing temperature
-    IceLat = [mIce*Temp[0]+bIce] #Array containing ice latittude
-    HystWay = [-1,] # Array containgn hyterisis way (-1 descending, 1 ascending)
-
-    # create the first loop over L to get the descending values 
+    LDesc = []
+    L = LRange[1]
+    while L > LRange[0] -1:
+        LDesc.append(L)
+        L = L - LStep
     
-    # intiate value for L
+    LAsc = []
+    L = LDesc[-1]
+    while L < LRange[1] + 1:
+        LAsc.append(L)
+        L = L + LStep
     
-    L = LArr[0]
+    # intitiate the data frame with its maximum size, each L taking one row for the starting 
+    # value, nIters rows for the iterations and one NaN row 
     
-    # do the L decreasing loop 
+    DF = np.empty(((len(LDesc) + len(LAsc))*(nIters+2), 6))
     
-    while L > LRange[0] -1:
-        
-        if L != LArr[0]:
-            # append the latest value to get iter number 0. I use -2 to not take into account the NaN values 
-        
-            LArr = np.append(LArr, L)
-            nIter = np.append(nIter, 0)
-            Temp = np.append(Temp, Temp[-2])
-            albedo = np.append(albedo, albedo[-2])
-            IceLat = np.append(IceLat, IceLat[-2])
-            HystWay = np.append(HystWay, -1)
-            
-        
-        # iterate over nIters 
+    # columns : L, nIter, temperature, albedo, ice latitude, hysteresis way
+    
+    Temp = (LRange[1]*(1-albedoIni)/(4*sigma*epsilon))**(1/4)
+    DF[0,:] = (LRange[1], 0, Temp, albedoIni, mIce*Temp+bIce, -1)
+    iRow = 1
+    lastRow = 0
+    
+    # do the L decreasing loop and then the L increasing one 
+    
+    for LArr, HystWay in ((LDesc, -1), (LAsc, 1)):
         
-        for i in range(nIters):
-            
-            # append the differnt data to the DF for Larr and nIter
-            
-            LArr = np.append(LArr, L)
-            nIter = np.append(nIter, i+1)
+        for L in LArr:
             
-            # calulate the temperature with previous value of albedo
+            if L != LRange[1] or HystWay == 1:
+                
+                # start from the latest converged value 
+                
+                DF[iRow,:] = DF[lastRow,:]
+                DF[iRow,0:2] = (L, 0)
+                DF[iRow,5] = HystWay
+                iRow = iRow + 1
+                
+            # iterate over nIters 
             
-            Temp = np.append(Temp,
-                             (L*(1-albedo[-1])/(4*sigma*epsilon))**(1/4))
-            
-            # calculate new albedo and Icelat val with last temp value 
-            
-            albedo = np.append(albedo,
-                               min(max(mAlbedo * Temp[-1] + bAlbedo,
-                                       albedoMin),
-                                   albedoMax))
-            IceLat = np.append(IceLat,
-                               min(max(mIce*Temp[-1] + bIce,
-                                       LatMin),
-                                   LatMax))
-            
-            HystWay = np.append(HystWay, -1)
-            
-        # add a line with NaN values 
-        
-        LArr = np.append(LArr, L)
-        nIter = np.append(nIter, np.nan)
-        Temp = np.append(Temp, np.nan)
-        albedo = np.append(albedo, np.nan)
-        IceLat = np.append(IceLat, np.nan)
-        HystWay = np.append(HystWay, -1)
+            for i in range(nIters):
+                
+                # calulate the temperature with previous value of albedo
+                
+                Temp = (L*(1-DF[iRow-1,3])/(4*sigma*epsilon))**(1/4)
+                
+                # calculate new albedo and Icelat val with last temp value 
+                
+                albedo = min(max(mAlbedo * Temp + bAlbedo,
+                                 albedoMin),
+                             albedoMax)
+                IceLat = min(max(mIce*Temp + bIce,
+                                 LatMin),
+                             LatMax)
+                
+                DF[iRow,:] = (L, i+1, Temp, albedo, IceLat, HystWay)
+                iRow = iRow + 1
+                
+                # stop once the temperature has settled, the starting row of the first L 
+                # being computed with albedoIni it is not compared to the first iteration 
+                
+                if tolerance is not None and i > 0 and abs(Temp - DF[iRow-2,2]) < tolerance:
+                    break
+                
+            # add a line with NaN values 
             
-        # decrease L value 
-        
-        L = L - LStep
-        
+            lastRow = iRow - 1
+            DF[iRow,:] = (L, np.nan, np.nan, np.nan, np.nan, HystWay)
+            iRow = iRow + 1
+    
+    return(DF[:iRow,:])
+    
 
-    # intiate value for L
+# create a function giving the clamped albedo and ice latitude of a temperature 
+
+def AlbedoIceLat(Temp,
+                 MeanTempVal):
+    '''Returns the albedo and ice latitude of temperatures from the clamped linear fits
     
-    L = LArr[-2]
+
+    Parameters
+    ----------
+    Temp : float or numpy array
+        Temperatures in K.
+    MeanTempVal : numpy array
+        numpy array with three colums : mean temp, ice altitutde and albedo.
+
+    Returns
+    -------
+    Albedo and ice latitude values.
+
+    '''
     
-    # do the L increasing loop 
+    # define constant
     
-    while L < LRange[1] + 1:
-        
-        # append the latest value to get iter number 0. I use -2 to not take into account the NaN values 
+    albedoMax = 0.65
+    albedoMin = 0.15
+    LatMax = 90
+    LatMin = 0
+    
+    mIce, bIce, mAlbedo, bAlbedo = FitParam(MeanTempVal)
+    
+    albedo = np.clip(mAlbedo * np.asarray(Temp) + bAlbedo, albedoMin, albedoMax)
+    IceLat = np.clip(mIce * np.asarray(Temp) + bIce, LatMin, LatMax)
+    
+    return(albedo, IceLat)
+
+# create a function giving the solar constant in equilibrium with a temperature 
+
+def EquilibriumL(Temp,
+                 epsilon: float,
+                 MeanTempVal):
+    '''Returns the solar energy constant for which a temperature is an equilibrium
+    
+    The equilibrium L(1-albedo(T))/4 = epsilon*sigma*T^4 is explicit in L, so the whole 
+    equilibrium curve is followed by going through the temperatures.
+
+    Parameters
+    ----------
+    Temp : float or numpy array
+        Temperatures in K.
+    epsilon : float
+        emissivity reflecting the energy emmission of a body regarding the emission of a black body. Float between 0 and 1.
+    MeanTempVal : numpy array
+        numpy array with three colums : mean temp, ice altitutde and albedo.
+
+    Returns
+    -------
+    Solar energy constant in W.m-2.
+
+    '''
+    
+    sigma = 5.67E-8 # W.m-2.K-4
+    
+    albedo = AlbedoIceLat(Temp, MeanTempVal)[0]
+    
+    return(4*sigma*epsilon*np.asarray(Temp)**4/(1-albedo))
+
+# create a function to find the tipping points of the hysteresis loop 
+
+def TippingPoints(epsilon: float,
+                  MeanTempVal):
+    '''Returns the critical solar energy constants where an equilibrium branch appears or vanishes
+    
+    These are the local extrema of the equilibrium curve L(T). They can only be at the two 
+    temperatures where the albedo reaches its bounds or where the derivative of L(T) on the 
+    partially ice covered branch vanishes, at T = 4(1-bAlbedo)/(3 mAlbedo).
+
+    Parameters
+    ----------
+    epsilon : float
+        emissivity reflecting the energy emmission of a body regarding the emission of a black body. Float between 0 and 1.
+    MeanTempVal : numpy array
+        numpy array with three colums : mean temp, ice altitutde and albedo.
+
+    Returns
+    -------
+    Numpy array with L, temperature, albedo, ice latitude and hysteresis way of each tipping point, 
+    sorted by temperature. The way is 1 when the colder branch vanishes as L increases past the 
+    point and -1 when the warmer branch vanishes as L decreases past it.
+
+    '''
+    
+    # define constant
+    
+    albedoMax = 0.65
+    albedoMin = 0.15
+    
+    mIce, bIce, mAlbedo, bAlbedo = FitParam(MeanTempVal)
+    
+    # get the candidate temperatures, the albedo law being flat there is no candidate 
+    
+    if mAlbedo == 0:
+        return(np.empty((0, 5)))
+    
+    TCand = [(albedoMax - bAlbedo)/mAlbedo,
+             (albedoMin - bAlbedo)/mAlbedo,
+             4*(1 - bAlbedo)/(3*mAlbedo)]
+    TCand = np.array(sorted(T for T in TCand if T > 0))
+    
+    # keep the ones where L(T) changes its way
+    
+    h = 1E-6*TCand
+    LCand = EquilibriumL(TCand, epsilon, MeanTempVal)
+    dLeft = LCand - EquilibriumL(TCand - h, epsilon, MeanTempVal)
+    dRight = EquilibriumL(TCand + h, epsilon, MeanTempVal) - LCand
+    
+    isTip = np.sign(dLeft) != np.sign(dRight)
+    TTip = TCand[isTip]
+    albedo, IceLat = AlbedoIceLat(TTip, MeanTempVal)
+    
+    return(np.array([LCand[isTip], TTip, albedo, IceLat, np.sign(dLeft[isTip])]).transpose())
+
+# create a function giving all the equilibrium temperatures regarding L
+
+def EquilibriumDF(LValues,
+                  epsilon: float,
+                  MeanTempVal,
+                  nBisect: int = 60):
+    '''Returns a data frame of all the equilibrium temperatures for each solar energy constant
+    
+    The equilibrium curve L(T) is split at the tipping points in pieces where it is monotone. On each 
+    piece there is at most one equilibrium per L, found by bisection for all the L values at once.
+
+    Parameters
+    ----------
+    LValues : numpy array
+        Solar energy constants in W.m-2.
+    epsilon : float
+        emissivity reflecting the energy emmission of a body regarding the emission of a black body. Float between 0 and 1.
+    MeanTempVal : numpy array
+        numpy array with three colums : mean temp, ice altitutde and albedo.
+    nBisect : int
+        Number of bisection steps, each one halves the temperature uncertainty.
+
+    Returns
+    -------
+    Numpy array with L, temperature, albedo, ice latitude, stability (1 stable, -1 unstable) and 
+    branch number (from the coldest one) of each equilibrium, ordered by branch and L.
+
+    '''
+    
+    sigma = 5.67E-8 # W.m-2.K-4
+    
+    LValues = np.asarray(LValues, dtype=float)
+    
+    # define the monotone pieces between 0 K and a temperature warmer than any equilibrium 
+    
+    TTip = TippingPoints(epsilon, MeanTempVal)[:,1]
+    TMax = (np.max(LValues)/(4*sigma*epsilon))**(1/4) + 1
+    TBounds = np.concatenate(([0.], TTip, [max(TMax, np.max(TTip, initial=0) + 1)]))
+    
+    out = []
+    
+    for iBranch in range(len(TBounds) - 1):
         
-        LArr = np.append(LArr, L)
-        nIter = np.append(nIter, 0)
-        Temp = np.append(Temp, Temp[-2])
-        albedo = np.append(albedo, albedo[-2])
-        IceLat = np.append(IceLat, IceLat[-2])
-        HystWay = np.append(HystWay, 1)
-            
+        TLow = np.full(LValues.shape, TBounds[iBranch])
+        THigh = np.full(LValues.shape, TBounds[iBranch+1])
+        LLow = EquilibriumL(TBounds[iBranch], epsilon, MeanTempVal)
+        LHigh = EquilibriumL(TBounds[iBranch+1], epsilon, MeanTempVal)
         
-        # iterate over nIters 
+        # bisect for the L values inside the piece 
         
-        for i in range(nIters):
-            
-            # append the differnt data to the DF for Larr and nIter
-            
-            LArr = np.append(LArr, L)
-            nIter = np.append(nIter, i+1)
-            
-            # calulate the temperature with previous value of albedo
-            
-            Temp = np.append(Temp,
-                             (L*(1-albedo[-1])/(4*sigma*epsilon))**(1/4))
-            
-            # calculate new albedo and Icelat val with last temp value 
-            
-            albedo = np.append(albedo,
-                               min(max(mAlbedo * Temp[-1] + bAlbedo,
-                                       albedoMin),
-                                   albedoMax))
-            IceLat = np.append(IceLat,
-                               min(max(mIce*Temp[-1] + bIce,
-                                       LatMin),
-                                   LatMax))
-            
-            HystWay = np.append(HystWay, 1)
-            
-        # add a line with NaN values 
+        way = np.sign(LHigh - LLow)
+        for i in range(nBisect):
+            TMid = (TLow + THigh)/2
+            below = (EquilibriumL(TMid, epsilon, MeanTempVal) - LValues)*way < 0
+            TLow = np.where(below, TMid, TLow)
+            THigh = np.where(below, THigh, TMid)
         
-        LArr = np.append(LArr, L)
-        nIter = np.append(nIter, np.nan)
-        Temp = np.append(Temp, np.nan)
-        albedo = np.append(albedo, np.nan)
-        IceLat = np.append(IceLat, np.nan)
-        HystWay = np.append(HystWay, 1)
-            
-        # increase L value 
+        inside = (LValues >= min(LLow, LHigh)) & (LValues <= max(LLow, LHigh))
+        Temp = ((TLow + THigh)/2)[inside]
+        albedo, IceLat = AlbedoIceLat(Temp, MeanTempVal)
         
-        L = L + LStep
-    
-    return(np.array([LArr,nIter,Temp,albedo,IceLat, HystWay]).transpose())
+        out.append(np.array([LValues[inside], Temp, albedo, IceLat,
+                             np.full(Temp.shape, way), np.full(Temp.shape, iBranch)]).transpose())
     
+    return(np.vstack(out))
 
 def plotTempAlbedo(TempAlbedoArray,
                     Parameter = "Temperature",
@@ -237,8 +372,8 @@ def plotTempAlbedo(TempAlbedoArray,
     # restrain the array regarding the LValue
     
     if plotIter == False:
-        # get only the latest values form the data 
-        DF = TempAlbedoArray[TempAlbedoArray[:,1] == max(TempAlbedoArray[:,1])]
+        # get only the latest values form the data, which are the rows before the NaN ones 
+        DF = TempAlbedoArray[np.where(np.isnan(TempAlbedoArray[:,1]))[0] - 1]
         x_list = DF[:,0]
         xlab = "L (W/m2)"
     elif plotIter == True:
@@ -277,6 +412,55 @@ def plotTempAlbedo(TempAlbedoArray,
     plt.xlabel(xlab)
     plt.ylabel(ylab)
     plt.show()
+
+def plotEquilibrium(EquilibriumArray,
+                    TippingArray = None,
+                    Parameter = "Temperature"):
+    '''Returns a plot of the equilibrium branches versus L 
+
+    Parameters
+    ----------
+    EquilibriumArray : numpy array
+        Numpy array obtained via the EquilibriumDF function
+    TippingArray : numpy array
+        Numpy array obtained via the TippingPoints function, plotted as points if given
+    Parameter : string
+        Parameter to plot, either Temperature, Albedo or Ice Latitude
+
+    Returns
+    -------
+    Plot of the stable (plain) and unstable (dashed) branches.
+
+    '''
+    
+    # define the y column 
+    
+    if Parameter == "Temperature":
+        iCol = 1
+        ylab = "Temperature (K)"
+    elif Parameter == "Albedo":
+        iCol = 2
+        ylab = "Albedo"
+    elif Parameter == "IceLatitude":
+        iCol = 3
+        ylab = "Ice Latitude (° C)"
+    else: 
+        print("The Parameter does not have the good definition")
+        return(None)
+    
+    # plot each branch 
+    
+    for iBranch in np.unique(EquilibriumArray[:,5]):
+        DF = EquilibriumArray[EquilibriumArray[:,5] == iBranch]
+        style = "-" if DF[0,4] == 1 else "--"
+        plt.plot(DF[:,0], DF[:,iCol], style, color = "C0")
+        
+    if TippingArray is not None:
+        plt.plot(TippingArray[:,0], TippingArray[:,iCol], "o", color = "C3")
+        
+    plt.xlabel("L (W/m2)")
+    plt.ylabel(ylab)
+    plt.show()
             
         
 if __name__ == "__main__":
@@ -317,6 +501,20 @@ if __name__ == "__main__":
                     plotIter=plotIter,
                     LWay= LWay)  
     
+    # get the same hysteresis directly from the equilibrium branches and the tipping points 
+    
+    resEq = EquilibriumDF(LValues = np.arange(LRange[0], LRange[1] + 1, 1), 
+                          epsilon = epsilon, 
+                          MeanTempVal = MeanTempVal)
+    resTip = TippingPoints(epsilon = epsilon, 
+                           MeanTempVal = MeanTempVal)
+    
+    plotEquilibrium(EquilibriumArray = resEq, 
+                    TippingArray = resTip, 
+                    Parameter = Parameter)
+    
+    print(resTip[:,0:2])
+    
     # print the latest results 
     
     # restrain the data 